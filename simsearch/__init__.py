@@ -13,3 +13,9 @@ __license__ = 'GPL'
 from bsets import *
 from simsphinx import *
 from indexer import *
+from features import *
+from parallel import *
+from inverted import *
+from lsh import *
+from cache import *
+from server import *
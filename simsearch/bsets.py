@@ -1,15 +1,24 @@
 """This is module is an implementation of Bayesian Sets."""
 
-__all__ = ['ComputedIndex', 'QueryHandler', 'load_index']
+__all__ = ['ComputedIndex', 'QueryHandler', 'QueryContext', 'load_index']
 
+import copy
+import itertools
 import random
 import scipy
+import threading
 from scipy import sparse
 
 import indexer
+import parallel
 import utils
+from inverted import InvertedScorer
+from lsh import MinHashLSH
 from utils import logger
 
+# identifies the computed index a query handler was set up with, for the cache keys
+_tokens = itertools.count()
+
 
 class ComputedIndex(utils.Serializable):
     """"This class represents a computed index.
@@ -18,14 +27,99 @@ class ComputedIndex(utils.Serializable):
     already computed.
 
     A computed index can then be queried using a QueryHandler object or saved
-    into a file.
+    into a file. It can also be saved as a snapshot which is memory mapped
+    when loaded back (see dump_snapshot and load_snapshot).
+
+    The data appended to the index (in mode 'append') after the computed
+    index was created is merged with update, without recomputing the index.
+
+    The deleted items are marked in the boolean array deleted (None if no
+    item is deleted). They are left out of the hyper parameters and they are
+    never scored.
+
+    The matrix is binary unless otherwise specified by weighting:
+
+        binary  : every feature of an item has the value 1
+        tf      : the values stored in a weighted index (1 if none)
+        tf-idf  : the values multiplied by the inverse document frequency
+
+    Bayesian Sets expects values between 0 and 1, so the weighted values of
+    each item are then divided by their maximum (norm='max') or by their
+    L2 norm (norm='l2'). The weighting is done once, when the computed index
+    is created.
+
+    The features found in less than min_df items or in more than a ratio
+    max_df of the items are pruned, and only the max_features most frequent
+    features are kept if specified. The array column_map then gives the
+    column of each feature of the index in the matrix (-1 if pruned).
+
+    The values of the matrix and the hyper parameters are float64 unless
+    otherwise specified by dtype. With dtype='float32' the matrix takes 8
+    bytes per non zero element instead of 12 and the scores are computed in
+    single precision, which may reorder items whose scores differ by less
+    than about 1e-6 of their magnitude. The mean and the log scores are kept
+    in float64. The values of a binary matrix are all ones, so they are
+    skipped when scoring a few items.
     """
-    def __init__(self, index_path):
+    HYPER_PARAMETERS = ('mean', 'alpha', 'beta', 'alpha_plus_beta',
+        'log_alpha', 'log_beta', 'log_alpha_plus_beta')
+    WEIGHTINGS = ('binary', 'tf', 'tf-idf')
+    NORMS = ('max', 'l2')
+    DTYPES = ('float64', 'float32')
+    deleted = None
+    weighting = 'binary'
+    norm = 'max'
+    idf = None
+    column_map = None
+    dtype = scipy.dtype(scipy.float64)
+
+    def __init__(self, index_path, weighting='binary', norm='max', min_df=1, max_df=1.0,
+        max_features=None, dtype='float64'):
         """ Creates a computed index from the path to an index.
+
+        If the index has been converted into the binary format, the matrix
+        and the indices are memory mapped instead, unless the text index has
+        changed since it was converted.
         """
-        index = self._load_file_index(index_path)
-        self._create_indexes(index.ids, index.fts)
-        self._compute_matrix_to_csr(index.xco, index.yco)
+        if weighting not in self.WEIGHTINGS:
+            raise Exception('Incorrect weighting %s, choose %s' % (weighting, ', '.join(self.WEIGHTINGS)))
+        if norm not in self.NORMS:
+            raise Exception('Incorrect norm %s, choose %s' % (norm, ', '.join(self.NORMS)))
+        if dtype not in self.DTYPES:
+            raise Exception('Incorrect dtype %s, choose %s' % (dtype, ', '.join(self.DTYPES)))
+        self.dtype = scipy.dtype(dtype)
+        self.index_path = index_path
+        self.version = 0
+        self.weighting = weighting
+        self.norm = norm
+        binary = indexer.BinaryIndex.exists(index_path)
+        if binary:
+            header = indexer.BinaryIndex.read_header(index_path)
+            if indexer.text_index_changes(header):
+                logger.warning('The text index %s has changed since it was converted, reading it instead ...',
+                    header['text_index_path'])
+                self.index_path = index_path = header['text_index_path']
+                binary = False
+        if binary:
+            index = self._load_binary_index(index_path)
+            self.index_path = index.header.get('text_index_path', index_path)
+            self._create_compact_indexes(index.ids, index.ids_order, index.fts)
+            self._make_csr_matrix(index.indptr, index.indices, getattr(index, 'values', None))
+            self._set_deleted(self._read_deleted(index))
+            self.text_offsets = index.header.get('text_offsets')
+            self.text_checksums = index.header.get('text_checksums')
+        else:
+            index = self._load_file_index(index_path)
+            self._create_compact_indexes(index.item_ids, None,
+                utils.StringTable.from_strings(index.features))
+            self._compute_matrix_to_csr(index.xco, index.yco, index.values)
+            self._set_deleted(index.tombstones)
+            self.text_offsets = index.offsets
+            self.text_checksums = indexer.text_index_checksums(index_path, index.offsets)
+        if min_df > 1 or max_df < 1 or max_features:
+            self._prune_features(min_df, max_df, max_features)
+        if weighting != 'binary':
+            self._weight_matrix()
         self._compute_hyper_parameters()
         index.close()
             
@@ -33,57 +127,576 @@ class ComputedIndex(utils.Serializable):
     def _load_file_index(self, index_path):
         logger.info("Loading file index ...")
         return indexer.FileIndex(index_path, mode='read')
-        
+
+    @utils.show_time_taken
+    def _load_binary_index(self, index_path):
+        logger.info("Loading binary index ...")
+        return indexer.BinaryIndex(index_path)
+
     @utils.show_time_taken
-    def _create_indexes(self, ids, fts):
-        logger.info("Creating indices ...")
-        self.item_id_to_index = dict(ids)
-        self.index_to_item_id = dict((i, id) for id, i in ids.iteritems())
-        self.index_to_feat = dict((i, ft) for ft, i in fts.iteritems())
+    def _create_compact_indexes(self, ids, ids_order, fts):
+        logger.info("Creating compact indices ...")
+        self.item_id_to_index = utils.make_id_map(ids, ids_order)
+        self.index_to_item_id = ids
+        self.index_to_feat = fts
         self.no_items = len(ids)
         self.no_features = len(fts)
 
     @utils.show_time_taken
-    def _compute_matrix_to_csr(self, xco, yco):
+    def _make_csr_matrix(self, indptr, indices, values=None):
+        logger.info("Creating CSR matrix ...")
+        if values is None or self.weighting == 'binary':
+            data = scipy.ones(len(indices), dtype=self.dtype)
+        else:
+            data = scipy.array(values, dtype=self.dtype)
+        self.X = sparse.csr_matrix((data, indices, indptr),
+            shape=(self.no_items, self.no_features))
+        
+    @utils.show_time_taken
+    def _compute_matrix_to_csr(self, xco, yco, values=None):
         logger.info("Creating CSR matrix ...")
-        data = scipy.ones(len(xco))
-        self.X = sparse.csr_matrix((data, (xco, yco)))
+        self.X = self._make_matrix(xco, yco, values)
+
+    def _make_matrix(self, xco, yco, values=None, shape=None):
+        # duplicated coordinates must not be summed
+        shape = shape or (self.no_items, self.no_features)
+        if values is None or self.weighting == 'binary':
+            X = sparse.csr_matrix((scipy.ones(len(xco), dtype=self.dtype), (xco, yco)), shape=shape)
+            X.data[:] = 1
+            return X
+        keys, first = scipy.unique(indexer.pack_keys(xco, yco), return_index=True)
+        values = scipy.asarray(values, dtype=self.dtype)[first]
+        return sparse.csr_matrix((values, (scipy.asarray(xco)[first], 
+            scipy.asarray(yco)[first])), shape=shape)
+
+    @utils.show_time_taken
+    def _prune_features(self, min_df=1, max_df=1.0, max_features=None):
+        logger.info("Pruning features ...")
+        df = scipy.bincount(self.X.indices, minlength=self.no_features)
+        keep = (df >= min_df) & (df <= max_df * self.no_items)
+        if max_features and keep.sum() > max_features:
+            # the most frequent features, ties broken by smallest column
+            columns = keep.nonzero()[0]
+            keep[:] = False
+            keep[columns[utils.argsort_best(df[columns], max_features, reverse=True)]] = True
+        columns = keep.nonzero()[0]
+        logger.info("Keeping %s features out of %s ...", len(columns), self.no_features)
+
+        self.column_map = scipy.cumsum(keep) - 1
+        self.column_map[~keep] = -1
+        self.X = self.X[:,columns]
+        self.index_to_feat = self.index_to_feat.take(columns)
+        self.no_features = len(columns)
+
+    def _remap_columns(self, xco, yco, values, no_new_features):
+        # the new features are appended, the pruned features are left out
+        column_map = scipy.concatenate((self.column_map, 
+            scipy.arange(self.no_features, self.no_features + no_new_features)))
+        yco = column_map[yco]
+        kept = yco != -1
+        if values is not None:
+            values = values[kept]
+        return column_map, scipy.asarray(xco)[kept], yco[kept], values
+
+    @utils.show_time_taken
+    def _weight_matrix(self):
+        logger.info("Weighting the matrix (%s, %s norm) ...", self.weighting, self.norm)
+        if self.weighting == 'tf-idf':
+            self.idf = self._compute_idf(self.X)
+        self._weight_rows(self.X)
+
+    @staticmethod
+    def _compute_idf(X):
+        # smoothed so that a feature found in every item keeps some weight
+        df = scipy.bincount(X.indices, minlength=X.shape[1])
+        return scipy.log((1. + X.shape[0]) / (1. + df)) + 1
+
+    def _weight_rows(self, X, idf=None):
+        if len(X.data) and X.data.min() < 0:
+            raise Exception('The values of the features must be positive!')
+        idf = self.idf if idf is None else idf
+        if idf is not None:
+            X.data *= idf[X.indices]
+        if self.norm == 'l2':
+            norms = scipy.sqrt(scipy.asarray(X.multiply(X).sum(1)).ravel())
+        else:
+            norms = X.max(1).toarray().ravel()
+        norms[norms == 0] = 1
+        X.data /= norms.repeat(scipy.diff(X.indptr))
             
+    def _set_deleted(self, deleted):
+        if deleted is not None and deleted.any():
+            self.deleted = scipy.asarray(deleted, dtype=bool)
+        else:
+            self.deleted = None
+
+    def _read_deleted(self, index):
+        # the items deleted from the text index since the binary index was written as well
+        deleted = getattr(index, 'deleted', None)
+        text_index_path = index.header.get('text_index_path')
+        if text_index_path:
+            tombstones = indexer.read_tombstones(text_index_path, self.no_items)
+            deleted = tombstones if deleted is None else deleted | tombstones
+        return deleted
+
+    def _compute_mean(self):
+        # in float64 whatever the dtype of the matrix
+        if self.deleted is None:
+            return scipy.asarray(self.X.mean(0, dtype=scipy.float64)).ravel()
+        live = ~self.deleted
+        column_sums = self.X.transpose() * live.astype(scipy.float64)
+        return column_sums / max(live.sum(), 1)
+
     @utils.show_time_taken
-    def _compute_hyper_parameters(self, c=2):
+    def _compute_hyper_parameters(self, c=2, mean=None):
         logger.info("Computing hyper parameters ...")
-        self.mean = self.X.mean(0)
-        self.alpha = c * self.mean
-        self.beta = c * (1 - self.mean)
-        self.alpha_plus_beta = self.alpha + self.beta
-        self.log_alpha_plus_beta = scipy.log(self.alpha_plus_beta)
-        self.log_alpha = scipy.log(self.alpha)
-        self.log_beta = scipy.log(self.beta)
-        
-        
+        self.mean = self._compute_mean() if mean is None else mean
+        alpha = c * self.mean
+        beta = c * (1 - self.mean)
+        alpha_plus_beta = alpha + beta
+        self._set_hyper_parameters(alpha=alpha, beta=beta, alpha_plus_beta=alpha_plus_beta,
+            log_alpha_plus_beta=scipy.log(alpha_plus_beta), log_alpha=scipy.log(alpha),
+            log_beta=scipy.log(beta))
+
+    def _set_hyper_parameters(self, **parameters):
+        # flat contiguous arrays of the dtype of the matrix, except for the mean
+        for name, value in parameters.iteritems():
+            value = scipy.asarray(value).ravel()
+            if name != 'mean':
+                value = scipy.ascontiguousarray(value, dtype=self.dtype)
+            setattr(self, name, value)
+
+    @utils.show_time_taken
+    def update(self, index_path=None):
+        """Merges the items and features appended to the index since this
+        computed index was created or last updated.
+
+        The new entries are read from the end of the index files and the
+        hyper parameters are updated from the column sums of the new entries.
+        The items deleted in the meantime are updated as well. The query
+        handlers of this index pick up the changes on their next query.
+
+        If the matrix is weighted, the new items are weighted with the
+        inverse document frequencies computed when the index was created.
+        The features of items already in a weighted matrix can't be updated.
+
+        The new state is assigned once it has been computed, so the queries
+        running in the meantime keep using the previous one.
+
+        If the index has been written again since (for example compacted, see
+        indexer.compact_index), the computed index must be created again.
+        """
+        index_path = index_path or self.index_path
+        if getattr(self, 'text_offsets', None) is None:
+            raise Exception('Unknown position of the last update in %s' % index_path)
+        changes = indexer.text_index_changes(dict(text_index_path=index_path,
+            text_offsets=self.text_offsets, text_checksums=getattr(self, 'text_checksums', None)))
+        if changes == 'rewritten':
+            raise Exception('The index %s has been written again since the computed index was '
+                'created, the computed index must be created again' % index_path)
+        logger.info("Reading the entries appended to %s ...", index_path)
+        delta = indexer.FileIndex(index_path, mode='read', offsets=self.text_offsets)
+        delta.close()
+        if self.weighting != 'binary' and len(delta.xco) and min(delta.xco) < self.no_items:
+            raise Exception('Can\'t update the features of the items of a weighted matrix, '
+                'the computed index must be created again')
+
+        no_items, no_features = self.no_items, self.no_features
+        no_live = no_items - (0 if self.deleted is None else self.deleted.sum())
+        new_ids, new_fts = delta.item_ids, delta.features
+        xco, yco, values = delta.xco, delta.yco, delta.values
+        column_map = self.column_map
+        if column_map is not None:
+            column_map, xco, yco, values = self._remap_columns(xco, yco, values, len(new_fts))
+        item_id_to_index, index_to_feat = self._update_indexes(new_ids, new_fts)
+        shape = (no_items + len(new_ids), no_features + len(new_fts))
+        logger.info("Merging %s entries, %s new items and %s new features ...",
+            len(xco), len(new_ids), len(new_fts))
+
+        X_delta = self._make_matrix(xco, yco, values, shape)
+        idf = self.idf
+        if self.weighting != 'binary':
+            if idf is not None:
+                idf = scipy.concatenate((idf, self._compute_idf(X_delta[:,no_features:])))
+            self._weight_rows(X_delta, idf)
+        X = self._merge_csr_matrix(X_delta, no_items)
+        if self.weighting == 'binary':
+            # the features added again to an item are not summed
+            X.data[:] = 1
+
+        old_deleted = scipy.zeros(shape[0], dtype=bool)
+        if self.deleted is not None:
+            old_deleted[:no_items] = self.deleted
+        deleted = indexer.read_tombstones(index_path, shape[0])
+        newly_deleted = (deleted & ~old_deleted)[:no_items].nonzero()[0]
+
+        # the column sums over the items which are not deleted
+        column_sums = self.mean * no_live
+        column_sums = scipy.concatenate((column_sums, scipy.zeros(len(new_fts))))
+        column_sums += X_delta.transpose() * (~deleted).astype(scipy.float64)
+        column_sums -= scipy.asarray(X[newly_deleted].sum(0)
+            - X_delta[newly_deleted].sum(0)).ravel()
+        no_live = shape[0] - deleted.sum()
+
+        self.item_id_to_index, self.index_to_feat = item_id_to_index, index_to_feat
+        self.index_to_item_id = item_id_to_index.ids
+        self.no_items, self.no_features = shape
+        self.column_map, self.idf, self.X = column_map, idf, X
+        self._set_deleted(deleted)
+        self._compute_hyper_parameters(mean=column_sums / max(no_live, 1))
+        self.text_offsets = delta.offsets
+        self.text_checksums = indexer.text_index_checksums(index_path, delta.offsets)
+        self.version = getattr(self, 'version', 0) + 1
+
+    def _update_indexes(self, new_ids, new_fts):
+        # extended copies, the current objects may be in use by the queries
+        ids = scipy.concatenate((self.index_to_item_id, new_ids)).astype(scipy.int64)
+        if isinstance(self.item_id_to_index, utils.DenseIdMap) and not utils.DenseIdMap.is_dense(ids):
+            item_id_to_index = utils.SortedIdMap(ids)
+        else:
+            item_id_to_index = copy.copy(self.item_id_to_index)
+            item_id_to_index.extend(new_ids)
+        index_to_feat = copy.copy(self.index_to_feat)
+        index_to_feat.extend(new_fts)
+        return item_id_to_index, index_to_feat
+
+    def _merge_csr_matrix(self, X_delta, no_items):
+        X = self.X
+        if X_delta.indptr[no_items] == 0:
+            # only new items, the new rows are stacked below the matrix
+            X = sparse.csr_matrix((X.data, X.indices, X.indptr), shape=(no_items, X_delta.shape[1]))
+            return sparse.vstack([X, X_delta[no_items:]], format='csr')
+        indptr = scipy.concatenate((X.indptr, X.indptr[-1:].repeat(X_delta.shape[0] - no_items)))
+        return sparse.csr_matrix((X.data, X.indices, indptr), shape=X_delta.shape) + X_delta
+
+    @utils.show_time_taken
+    def dump_snapshot(self, index_path):
+        """Saves this computed index as a snapshot in the given path.
+
+        The snapshot is a binary index together with the CSR data and the
+        hyper parameters, all stored as flat arrays.
+        """
+        logger.info("Saving snapshot ...")
+        arrays = dict((name, scipy.asarray(getattr(self, name)))
+            for name in self.HYPER_PARAMETERS)
+        arrays['data'] = self.X.data
+        if self.deleted is not None:
+            arrays['deleted'] = self.deleted
+        if self.idf is not None:
+            arrays['idf'] = self.idf
+        if self.column_map is not None:
+            arrays['column_map'] = self.column_map
+        indexer.BinaryIndex.write(index_path, self.index_to_item_id, self.X,
+            self.index_to_feat, arrays, snapshot=True, text_index_path=getattr(self, 'index_path', None),
+            text_offsets=getattr(self, 'text_offsets', None), weighting=self.weighting, norm=self.norm,
+            dtype=self.dtype.name)
+
+    @staticmethod
+    def load_snapshot(index_path, mmap=True):
+        """Loads a computed index from a snapshot.
+
+        All arrays are memory mapped unless mmap is false, so nothing needs
+        to be computed or read in memory before the index is queried.
+
+        The entries appended to the text index since the snapshot was saved
+        are merged (see update). If the text index has been written again,
+        the snapshot must be saved again.
+        """
+        logger.info("Loading snapshot ...")
+        index = indexer.BinaryIndex(index_path, mmap)
+        if not index.header.get('snapshot'):
+            raise Exception('%s is not a snapshot of a computed index' % index_path)
+        changes = indexer.text_index_changes(index.header)
+        if changes == 'rewritten':
+            raise Exception('The text index %s has been written again since the snapshot %s was saved, '
+                'the snapshot must be saved again' % (index.header['text_index_path'], index_path))
+
+        self = ComputedIndex.__new__(ComputedIndex)
+        self.index_path = index.header.get('text_index_path', index_path)
+        self.text_offsets = index.header.get('text_offsets')
+        self.text_checksums = index.header.get('text_checksums')
+        self.version = 0
+        self.weighting = index.header.get('weighting', 'binary')
+        self.norm = index.header.get('norm', 'max')
+        self.idf = getattr(index, 'idf', None)
+        self.column_map = getattr(index, 'column_map', None)
+        self._create_compact_indexes(index.ids, index.ids_order, index.fts)
+        data = getattr(index, 'data', None)
+        self.dtype = scipy.dtype(index.header.get('dtype', 'float64') if data is None else data.dtype)
+        if data is None:
+            # saved without the values of its binary matrix
+            logger.warning('The snapshot %s has no data, save it again to memory map it ...', index_path)
+            data = scipy.ones(len(index.indices), dtype=self.dtype)
+        self.X = sparse.csr_matrix((data, index.indices, index.indptr),
+            shape=(self.no_items, self.no_features))
+        saved_deleted = getattr(index, 'deleted', None)
+        self._set_deleted(self._read_deleted(index))
+        self._set_hyper_parameters(**dict((name, getattr(index, name))
+            for name in self.HYPER_PARAMETERS))
+        if self.deleted is not None:
+            self._forget_deleted(saved_deleted)
+        index.close()
+        if changes == 'appended':
+            logger.info('Merging the entries appended since the snapshot was saved ...')
+            self.update()
+        return self
+
+    def _forget_deleted(self, saved_deleted):
+        # leaves the items deleted since the snapshot was saved out of the hyper parameters
+        newly_deleted = self.deleted if saved_deleted is None else self.deleted & ~saved_deleted
+        newly_deleted = newly_deleted.nonzero()[0]
+        if not len(newly_deleted):
+            return
+        no_live = self.no_items - (0 if saved_deleted is None else saved_deleted.sum())
+        column_sums = self.mean * no_live - scipy.asarray(self.X[newly_deleted].sum(0)).ravel()
+        no_live -= len(newly_deleted)
+        self._compute_hyper_parameters(mean=column_sums / max(no_live, 1))
+
+    @staticmethod
+    def is_snapshot(index_path):
+        """Returns whether a snapshot of a computed index is found in the path.
+        """
+        return (indexer.BinaryIndex.exists(index_path) and
+            indexer.BinaryIndex.read_header(index_path).get('snapshot', False))
+
+
 class QueryHandler(object):
     """This class is used to query a computed index.
+
+    If processes is set, the log scores are computed by a pool of processes
+    each scoring a shard of the matrix (see parallel.ShardedScorer).
+
+    If inverted is true, only the items sharing a feature with the query
+    items are visited, from an inverted view of the matrix (see
+    inverted.InvertedScorer). This is faster on very sparse matrices.
+
+    If lsh is set to a MinHashLSH object, only the candidates found by
+    locality sensitive hashing are scored (see lsh.MinHashLSH). The results
+    are approximate but the candidates are scored exactly.
+
+    If cache is set to a QueryCache object, the query vectors and the best
+    results are cached for the queries with the same items in any order (see
+    cache.QueryCache). The entries are keyed by the loaded index, so a cache
+    may be shared by several query handlers and the entries of an updated or
+    reloaded index are never returned, they are evicted as least recently used.
+
+    If chunk_size is set, the log scores are computed chunk_size rows at a
+    time and only the best results seen so far are kept (see utils.TopK), so
+    the memory taken by a query is bounded by the chunk size instead of the
+    number of items. All the log scores are still computed at once when
+    max_results is -1.
+
+    The state of each query is kept in a QueryContext object (see search), so
+    one query handler can serve the queries of many threads.
     """
-    def __init__(self, computed_index):
+    deleted = None
+    inverted_scorer = None
+    lsh = None
+    cache = None
+    chunk_size = None
+    min_score = None
+    last_context = None
+
+    def __init__(self, computed_index, processes=None, inverted=False, lsh=None, cache=None,
+        chunk_size=None):
         utils.auto_assign(self, vars(computed_index))
         self.computed_index = computed_index
+        self.token = _tokens.next()
         self.time = 0
-        
-    def query(self, item_ids, max_results=100):
+        self.scorer = None
+        self._baselines = {}
+        self._lock = threading.Lock()
+        if processes:
+            self.scorer = parallel.ShardedScorer(computed_index, processes)
+        if inverted:
+            self.inverted_scorer = InvertedScorer(computed_index)
+        self.lsh = lsh
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self._chunks = self._make_chunks() if chunk_size else None
+
+    def refresh(self):
+        """Picks up the changes made to the computed index (see ComputedIndex.update).
+
+        This is done automatically before each query.
+        """
+        utils.auto_assign(self, vars(self.computed_index))
+        self.token = _tokens.next()
+        self._baselines = {}
+        if self.scorer:
+            processes = self.scorer.processes
+            # waits for the queries in flight, the later queries of older contexts are not sharded
+            self.scorer.close()
+            self.scorer = parallel.ShardedScorer(self.computed_index, processes)
+        if self.inverted_scorer:
+            self.inverted_scorer = InvertedScorer(self.computed_index)
+        if self.lsh:
+            self.lsh = MinHashLSH(self.computed_index, self.lsh.no_bands, 
+                self.lsh.rows_per_band, self.lsh.seed)
+        if self.chunk_size:
+            self._chunks = self._make_chunks()
+
+    def _make_chunks(self):
+        # consecutive rows of the matrix, the arrays are views and are not copied
+        X, chunks = self.X, []
+        for start in xrange(0, X.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, X.shape[0])
+            a, b = X.indptr[start], X.indptr[end]
+            chunks.append((start, sparse.csr_matrix((X.data[a:b], X.indices[a:b], 
+                X.indptr[start:end+1] - a), shape=(end - start, X.shape[1]))))
+        return chunks
+
+    def _refresh_if_updated(self):
+        if getattr(self, 'version', 0) != getattr(self.computed_index, 'version', 0):
+            logger.info('The computed index has been updated ...')
+            self.refresh()
+
+    def new_context(self):
+        """Returns a new QueryContext object sharing the computed index and the
+        caches of this query handler, with an empty query.
+        """
+        # refreshed and copied at once so a context never sees a half refreshed handler
+        with self._lock:
+            self._refresh_if_updated()
+            return QueryContext(self)
+
+    def search(self, item_ids, max_results=100, candidate_ids=None, min_score=None,
+        positive_only=False):
+        """Queries the computed index against the given item ids and returns
+        a QueryContext object holding the state of this query.
+
+        The results are found in context.results. The query handler itself is
+        left untouched, so many threads can search with the same handler.
+        See query for the other arguments.
+        """
+        context = self.new_context()
+        context._search(item_ids, max_results, candidate_ids, min_score, positive_only)
+        return context
+
+    def query(self, item_ids, max_results=100, candidate_ids=None, min_score=None,
+        positive_only=False):
         """Queries the given computed against the given item ids.
+
+        If candidate_ids is specified, only these items are scored. The
+        candidates are either a list (or an array) of item ids, or a boolean
+        array marking the candidate rows of the matrix. If the query handler
+        has a MinHashLSH object, only the candidates it finds are scored.
+
+        If min_score is specified, only the items with a log score of at
+        least min_score are returned, and only the items with a positive log
+        score if positive_only is true. The other items are left out as they
+        are scored, before the best results are sorted, so max_results=-1
+        then only returns the items above the threshold.
+
+        The context of the query is kept in last_context (see search).
         """
+        self.last_context = context = self.search(item_ids, max_results, candidate_ids,
+            min_score, positive_only)
+        results = context.results
+        self.time = results.time
+        return results
+
+    def _search(self, item_ids, max_results=100, candidate_ids=None, min_score=None,
+        positive_only=False):
         item_ids = utils.listify(item_ids)
+        if positive_only:
+            # the smallest positive float, so a log score of 0 is left out
+            smallest = scipy.nextafter(0, 1)
+            min_score = smallest if min_score is None else max(min_score, smallest)
+        self.min_score = min_score
         if not self.is_valid_query(item_ids):
-            return self.empty_results
+            return
 
         logger.info('Computing the query vector ...')
         self._make_query_vector()
-        logger.info('Computing log scores ...')
-        self._compute_scores()
-        logger.info('Get the top %s log scores ...', max_results)
-        self._order_indexes_by_scores(max_results)
 
-        return self.results
+        # only the best results of all the items are cached
+        key = None
+        if self.cache is not None and candidate_ids is None and max_results != -1:
+            key = self._get_cache_key('results', max_results, min_score)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info('Found the top %s log scores in the cache ...', max_results)
+                self.ordered_indexes, self.ordered_scores = cached
+                return
+
+        indexes = None
+        if candidate_ids is not None:
+            indexes = self.get_candidate_indexes(candidate_ids)
+        if self.lsh:
+            logger.info('Finding the approximate candidates ...')
+            found = self._get_approximate_candidates()
+            indexes = found if indexes is None else scipy.intersect1d(indexes, found)
+        if indexes is not None:
+            logger.info('Computing the log scores of %s candidates ...', len(indexes))
+            self._compute_candidate_scores(indexes, max_results)
+        elif self.inverted_scorer:
+            logger.info('Computing the top %s log scores from the inverted view ...', max_results)
+            self._compute_inverted_scores(max_results)
+        elif self.scorer:
+            logger.info('Computing the top %s log scores in shards ...', max_results)
+            self._compute_sharded_scores(max_results)
+        elif self.chunk_size and max_results != -1:
+            logger.info('Computing the top %s log scores in chunks of %s items ...', 
+                max_results, self.chunk_size)
+            self._compute_chunked_scores(max_results)
+        else:
+            logger.info('Computing log scores ...')
+            self._compute_scores()
+            logger.info('Get the top %s log scores ...', max_results)
+            self._order_indexes_by_scores(max_results)
+        if key is not None:
+            self.cache.set(key, (self.ordered_indexes, self.ordered_scores))
+
+    def query_batch(self, item_ids_list, max_results=100, block_size=16):
+        """Queries the computed index against each list of item ids.
+
+        A query vector only differs from the baseline query vector of its
+        number of query items on the features of the query items. So the
+        scores of each baseline are computed once and the differences of all
+        the queries are stacked into a sparse matrix, which is scored
+        block_size queries at a time. The scores of a block, their negated
+        copy and the arrays selecting the best results of each query are all
+        no_items x block_size arrays, so a block takes up to about 32 x
+        no_items x block_size bytes at its peak.
+
+        Returns a list of ResultSet objects, one for each list of item ids.
+        """
+        return self.new_context()._query_batch(item_ids_list, max_results, block_size)
+
+    def _query_batch(self, item_ids_list, max_results=100, block_size=16):
+        item_ids_list = [utils.listify(item_ids) for item_ids in item_ids_list]
+        valid_ids_list = [[id for id in item_ids if self._is_live(id)]
+            for item_ids in item_ids_list]
+        queries = [i for i, ids in enumerate(valid_ids_list) if ids]
+
+        results = [ResultSet.get_empty_result_set(query_item_ids=item_ids, _query_item_ids=ids)
+            for item_ids, ids in zip(item_ids_list, valid_ids_list)]
+        if not queries:
+            return results
+
+        logger.info('Computing the query matrix of %s queries ...', len(queries))
+        dQ, c, N = self._make_query_matrix([valid_ids_list[i] for i in queries])
+        logger.info('Computing the top %s log scores of each query in blocks of %s queries ...',
+            max_results, block_size)
+        best = self._compute_batch_scores(dQ, c, N, max_results, block_size)
+
+        time = (
+            + getattr(self, '_time_taken__make_query_matrix', 0)
+            + getattr(self, '_time_taken__compute_batch_scores', 0)
+        )
+        for i, (indexes, scores) in zip(queries, best):
+            if self.deleted is not None:
+                live = ~self.deleted[indexes]
+                indexes, scores = indexes[live], scores[live]
+            results[i] = ResultSet(
+                time = time,
+                total_found = len(indexes),
+                query_item_ids  = item_ids_list[i],
+                _query_item_ids = valid_ids_list[i],
+                log_scores = LogScores(self.index_to_item_id.take(indexes), scores)
+            )
+        return results
 
     def get_detailed_scores(self, item_ids, query_item_ids=None, max_terms=20):
         """Returns detailed statistics about the matched items.
@@ -91,58 +704,300 @@ class QueryHandler(object):
         This will assume the same items previously queried unless otherwise
         specified by 'query_item_ids'.
         """
-        item_ids = utils.listify(item_ids)
-
-        logger.info('Computing detailed scores ...')
-        scores = self._compute_detailed_scores(item_ids, query_item_ids, max_terms)
-        
-        self._update_time_taken()
+        if query_item_ids is None and self.last_context:
+            query_item_ids = self.last_context.item_ids
+        context = self.new_context()
+        scores = context.get_detailed_scores(item_ids, query_item_ids, max_terms)
+        self.time = context.time
         return scores
 
     def get_sample_item_ids(self):
         """Returns some sample item ids from the index.
         """
-        return [self.index_to_item_id[i] for i in random.sample(xrange(self.no_items), 10)]
+        indexes = xrange(self.no_items)
+        if self.deleted is not None:
+            indexes = (~self.deleted).nonzero()[0]
+        return [int(self.index_to_item_id[i]) for i in random.sample(indexes, min(10, len(indexes)))]
 
     def is_valid_query(self, item_ids):
         """Checks whether the item ids are within the index.
         """
         self.item_ids = item_ids
-        self._item_ids = [id for id in item_ids if id in self.item_id_to_index]
+        self._item_ids = [id for id in item_ids if self._is_live(id)]
         return self._item_ids != []
 
+    def get_candidate_indexes(self, candidate_ids):
+        """Returns the sorted rows of the matrix of the given candidates.
+
+        The candidates which are not in the index or which have been deleted
+        are left out.
+        """
+        candidate_ids = scipy.asarray(candidate_ids)
+        if candidate_ids.dtype == bool:
+            if len(candidate_ids) != self.no_items:
+                raise Exception('The bitmap of the candidates must have %s rows' % self.no_items)
+            indexes = candidate_ids.nonzero()[0]
+        else:
+            indexes = self.item_id_to_index.lookup(candidate_ids)
+        indexes = scipy.unique(indexes[indexes != -1])
+        if self.deleted is not None:
+            indexes = indexes[~self.deleted[indexes]]
+        return indexes
+
+    @utils.show_time_taken
+    def _get_approximate_candidates(self):
+        indexes = self.lsh.get_candidates([self.item_id_to_index[id] for id in self._item_ids])
+        if self.deleted is not None:
+            indexes = indexes[~self.deleted[indexes]]
+        return indexes
+
+    def _is_live(self, id):
+        # whether the item is in the index and has not been deleted
+        i = self.item_id_to_index.get(id)
+        return i is not None and (self.deleted is None or not self.deleted[i])
+
+    def _get_cache_key(self, *args):
+        # the same for the same query items in any order and the same loaded version of the index,
+        # so a cache shared by other handlers or kept across reloads never serves stale results
+        return (self.token, tuple(sorted(self._item_ids))) + args
+
     @utils.show_time_taken
     def _make_query_vector(self):
+        key = None
+        if self.cache is not None:
+            key = self._get_cache_key('vector')
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.c, self.query_features, self.query_values, self.query_n = cached
+                self._q = None
+                return
+
+        self._compute_query_vector()
+        if key is not None:
+            self.cache.set(key, (self.c, self.query_features, self.query_values, self.query_n))
+
+    def _compute_query_vector(self):
         item_ids = self._item_ids
         N = len(item_ids)
+        q0, c0 = self._get_baseline(N)
+
+        # only the features of the query items differ from the baseline
+        positions, _ = utils.slice_positions(self.X.indptr,
+            [self.item_id_to_index[id] for id in item_ids])
+        features, inverse = scipy.unique(self.X.indices[positions], return_inverse=True)
+        weights = None if self.weighting == 'binary' else self.X.data[positions]
+        sum_xi = scipy.bincount(inverse, weights=weights, minlength=len(features))
 
-        sum_xi = self.X[self.item_id_to_index[item_ids[0]]]
-        for id in item_ids[1:]:
-            sum_xi = sum_xi + self.X[self.item_id_to_index[id]]
+        alpha, beta, log_alpha, log_beta = (getattr(self, name)[features].astype(scipy.float64)
+            for name in ('alpha', 'beta', 'log_alpha', 'log_beta'))
+        log_alpha_bar = scipy.log(alpha + sum_xi)
+        log_beta_bar = scipy.log(beta + N - sum_xi)
+
+        self.c = c0 + (log_beta_bar - scipy.log(beta + N)).sum()
+        self.query_features = features
+        self.query_values = log_alpha_bar - log_alpha - log_beta_bar + log_beta
+        self.query_n = N
+        self._q = None
+
+    @property
+    def q(self):
+        """The query vector, made from the baseline query vector and the values
+        of the features of the query items.
+        """
+        if self._q is None:
+            q = self._get_baseline(self.query_n)[0].copy()
+            q[self.query_features] = self.query_values
+            self._q = q
+        return self._q
 
-        alpha_bar = self.alpha + sum_xi
-        beta_bar = self.beta + N - sum_xi
-        log_alpha_bar = scipy.log(alpha_bar)
-        log_beta_bar = scipy.log(beta_bar)
+    def _get_query_values(self, features):
+        # the values of the query vector on the given features, in float64
+        q = self._get_baseline(self.query_n)[0][features].astype(scipy.float64)
+        if len(self.query_features):
+            pos = self.query_features.searchsorted(features).clip(0, len(self.query_features) - 1)
+            found = self.query_features[pos] == features
+            q[found] = self.query_values[pos[found]]
+        return q
 
-        self.c = (self.alpha_plus_beta - scipy.log(self.alpha_plus_beta + N)
-            + log_beta_bar - self.log_beta).sum()
-        self.q = log_alpha_bar - self.log_alpha - log_beta_bar + self.log_beta
+    def _get_baseline(self, N):
+        # the query vector and the constant of N items without any feature,
+        # computed in float64 but the query vector has the dtype of the matrix
+        baseline = self._baselines.get(N)
+        if baseline is None:
+            beta, log_beta, alpha_plus_beta, log_alpha_plus_beta = (getattr(self, name).astype(scipy.float64)
+                for name in ('beta', 'log_beta', 'alpha_plus_beta', 'log_alpha_plus_beta'))
+            log_beta_bar = scipy.log(beta + N)
+            q0 = (log_beta - log_beta_bar).astype(self.X.dtype)
+            c0 = (log_alpha_plus_beta - scipy.log(alpha_plus_beta + N) + log_beta_bar - log_beta).sum()
+            baseline = q0, c0
+            # the cache is shared by the contexts of the concurrent queries
+            if len(self._baselines) >= 16:
+                self._baselines.clear()
+            self._baselines[N] = baseline
+        return baseline
 
     @utils.show_time_taken
     def _compute_scores(self):
-        scores = self.X * self.q.transpose()
-        scores = scipy.asarray(scores).flatten()
-        self.log_scores = self.c + scores
+        # the constant is added in float64 so it does not round the scores away
+        self.log_scores = (self.X * self.q).astype(scipy.float64)
+        self.log_scores += self.c
+        if self.deleted is not None:
+            self.log_scores[self.deleted] = -scipy.inf
 
     @utils.show_time_taken
     def _order_indexes_by_scores(self, max_results=100):
-        if max_results == -1:
-            self.ordered_indexes = xrange(len(self.log_scores))
+        if self.min_score is not None:
+            # only the items above the threshold are sorted
+            self.ordered_indexes = (self.log_scores >= self.min_score).nonzero()[0]
+            if self.deleted is not None:
+                self.ordered_indexes = self.ordered_indexes[~self.deleted[self.ordered_indexes]]
+            if max_results != -1:
+                best = utils.argsort_best(self.log_scores[self.ordered_indexes], max_results, reverse=True)
+                self.ordered_indexes = self.ordered_indexes[best]
+            self.ordered_scores = self.log_scores[self.ordered_indexes]
+            logger.info('Got %s indexes ...', len(self.ordered_indexes))
+        elif max_results == -1 and self.deleted is None:
+            self.ordered_indexes = scipy.arange(len(self.log_scores))
+            self.ordered_scores = self.log_scores
         else:
-            self.ordered_indexes = utils.argsort_best(self.log_scores, max_results, reverse=True)
+            if max_results == -1:
+                self.ordered_indexes = (~self.deleted).nonzero()[0]
+            else:
+                self.ordered_indexes = utils.argsort_best(self.log_scores, max_results, reverse=True)
+                if self.deleted is not None:
+                    self.ordered_indexes = self.ordered_indexes[~self.deleted[self.ordered_indexes]]
+            self.ordered_scores = self.log_scores[self.ordered_indexes]
             logger.info('Got %s indexes ...', len(self.ordered_indexes))
 
+    @utils.show_time_taken
+    def _compute_chunked_scores(self, max_results=100):
+        top_k = utils.TopK(max_results, reverse=True)
+        q = self.q
+        for start, X in self._chunks:
+            log_scores = (X * q).astype(scipy.float64)
+            log_scores += self.c
+            if self.deleted is not None:
+                log_scores[self.deleted[start:start + len(log_scores)]] = -scipy.inf
+            if self.min_score is None:
+                top_k.push(log_scores, start)
+            else:
+                rows = (log_scores >= self.min_score).nonzero()[0]
+                top_k.push(log_scores[rows], indexes=rows + start)
+        self.ordered_indexes, self.ordered_scores = top_k.indexes, top_k.values
+        if self.deleted is not None:
+            live = ~self.deleted[self.ordered_indexes]
+            self.ordered_indexes, self.ordered_scores = self.ordered_indexes[live], self.ordered_scores[live]
+        logger.info('Got %s indexes ...', len(self.ordered_indexes))
+
+    @utils.show_time_taken
+    def _compute_candidate_scores(self, indexes, max_results=100):
+        positions, lengths = utils.slice_positions(self.X.indptr, indexes)
+        values = self._get_query_values(self.X.indices[positions])
+        if self.weighting != 'binary':
+            values *= self.X.data[positions]
+        log_scores = self.c + scipy.bincount(scipy.arange(len(indexes)).repeat(lengths),
+            weights=values, minlength=len(indexes))
+        if self.min_score is not None:
+            above = (log_scores >= self.min_score).nonzero()[0]
+            indexes, log_scores = indexes[above], log_scores[above]
+        if max_results == -1:
+            best = scipy.arange(len(indexes))
+        else:
+            best = utils.argsort_best(log_scores, max_results, reverse=True)
+        self.ordered_indexes = indexes[best]
+        self.ordered_scores = log_scores[best]
+        logger.info('Got %s indexes ...', len(self.ordered_indexes))
+
+    @utils.show_time_taken
+    def _compute_inverted_scores(self, max_results=100):
+        N = self.query_n
+        self.ordered_indexes, self.ordered_scores = self.inverted_scorer.score(self.c, 
+            max_results, N, self._get_baseline(N)[0], self.query_features, self.query_values,
+            self.min_score)
+        logger.info('Got %s indexes ...', len(self.ordered_indexes))
+
+    @utils.show_time_taken
+    def _compute_sharded_scores(self, max_results=100):
+        self.ordered_indexes, self.ordered_scores = self.scorer.score(
+            self.q, self.c, max_results, self.min_score)
+        logger.info('Got %s indexes ...', len(self.ordered_indexes))
+
+    @utils.show_time_taken
+    def _make_query_matrix(self, item_ids_list):
+        rows, cols = [], []
+        for j, item_ids in enumerate(item_ids_list):
+            rows.extend([j] * len(item_ids))
+            cols.extend(self.item_id_to_index[id] for id in item_ids)
+        data = scipy.ones(len(rows))
+        selection = sparse.csr_matrix((data, (rows, cols)),
+            shape=(len(item_ids_list), self.X.shape[0]))
+
+        # one row per query, only the features of the query items are summed
+        sum_xi = (selection * self.X).tocsr()
+        N = scipy.array([len(item_ids) for item_ids in item_ids_list])
+        queries = scipy.arange(len(item_ids_list)).repeat(scipy.diff(sum_xi.indptr))
+        n = N[queries]
+
+        alpha, beta, log_alpha = (getattr(self, name)[sum_xi.indices].astype(scipy.float64)
+            for name in ('alpha', 'beta', 'log_alpha'))
+        log_alpha_bar = scipy.log(alpha + sum_xi.data)
+        log_beta_bar = scipy.log(beta + n - sum_xi.data)
+        log_beta_bar_0 = scipy.log(beta + n)
+
+        # the constants and the query vectors minus those of the baselines
+        c = scipy.array([self._get_baseline(no)[1] for no in N.tolist()])
+        c += scipy.bincount(queries, weights=log_beta_bar - log_beta_bar_0, minlength=len(N))
+        dQ = sparse.csr_matrix((log_alpha_bar - log_alpha - log_beta_bar + log_beta_bar_0, 
+            sum_xi.indices, sum_xi.indptr), shape=sum_xi.shape)
+        return dQ, c, N
+
+    @utils.show_time_taken
+    def _compute_batch_scores(self, dQ, c, N, max_results=100, block_size=16):
+        # the scores of the baselines of each block, one per number of query items
+        base, best = {}, []
+        for start in xrange(0, dQ.shape[0], block_size):
+            end = min(start + block_size, dQ.shape[0])
+            block_N = N[start:end]
+            base = dict((no, base[no] if no in base else
+                (self.X * self._get_baseline(no)[0]).astype(scipy.float64))
+                for no in set(block_N.tolist()))
+
+            log_scores = (self.X * dQ[start:end].transpose()).toarray()
+            for no, scores in base.iteritems():
+                log_scores[:, (block_N == no).nonzero()[0]] += scores[:, scipy.newaxis]
+            log_scores += c[start:end]
+            if self.deleted is not None:
+                log_scores[self.deleted] = -scipy.inf
+
+            ordered_indexes = self._order_batch_indexes_by_scores(log_scores, max_results)
+            columns = scipy.arange(end - start)
+            best.extend(zip(ordered_indexes.transpose(), 
+                log_scores[ordered_indexes, columns].transpose()))
+        return best
+
+    def _order_batch_indexes_by_scores(self, log_scores, max_results=100):
+        n, no_queries = log_scores.shape
+        k = n if max_results == -1 else min(max_results, n)
+        if max_results == -1 or k == 0:
+            return scipy.arange(k).repeat(no_queries).reshape(k, no_queries)
+
+        # the k-th best score of every query at once, in a contiguous copy of the block
+        columns = scipy.arange(no_queries)
+        keys = scipy.negative(log_scores, order='C')
+        if k < n:
+            kth = keys[scipy.argpartition(keys, k-1, axis=0)[k-1], columns]
+            # the rows above it and the first rows tied with it, as in utils.argsort_best
+            best = keys < kth
+            ties = keys == kth
+            ties &= ties.cumsum(0) <= k - best.sum(0)
+            best |= ties
+            rows = best.transpose().nonzero()[1].reshape(no_queries, k).transpose()
+        else:
+            rows = scipy.arange(n).repeat(no_queries).reshape(n, no_queries)
+
+        # only the k rows are sorted, the ties stay ordered by smallest index
+        return rows[keys[rows, columns].argsort(0, kind='mergesort'), columns]
+
     @utils.show_time_taken
     def _compute_detailed_scores(self, item_ids, query_item_ids=None, max_terms=20):
         # if set to None we assume previously queried items
@@ -151,31 +1006,51 @@ class QueryHandler(object):
 
         # if the query vector is different than previously computed
         # or not computed at all, we need to recompute it.
-        if not hasattr(self, 'q') or query_item_ids != self.item_ids:
+        if not hasattr(self, 'query_values') or query_item_ids != self.item_ids:
             if not self.is_valid_query(query_item_ids):
                 return []
             else:
                 logger.info('Computing the query vector ...')
                 self._make_query_vector()
 
-        # computing the score for each item
-        scores = []
-        for id in item_ids:
-            if id not in self.item_id_to_index:
-                scores.append(utils._O(total_score=0, scores=[]))
-                continue
+        # the contributions of the features of all the items at once
+        live = [self._is_live(id) for id in item_ids]
+        rows = [self.item_id_to_index[id] for id, l in zip(item_ids, live) if l]
+        positions, lengths = utils.slice_positions(self.X.indptr, rows)
+        features = self.X.indices[positions]
+        contributions = self._get_query_values(features)
+        if self.weighting != 'binary':
+            contributions *= self.X.data[positions]
+        row_of = scipy.arange(len(rows)).repeat(lengths)
+        totals = scipy.bincount(row_of, weights=contributions, minlength=len(rows))
 
-            xi = self.X[self.item_id_to_index[id]]
-            xi_ind = xi.indices
-            
-            feat = (self.index_to_feat[i] for i in xi_ind)
-            
-            qi = self.q.transpose()[xi_ind]
-            qi = scipy.asarray(qi).flatten()
+        # the best max_terms of each row and the terms tied with the last one
+        order = scipy.lexsort((-contributions, row_of))
+        features, contributions = features[order], contributions[order]
+        if max_terms >= 0:
+            starts = scipy.cumsum(lengths) - lengths
+            keep = scipy.arange(len(order)) - starts.repeat(lengths) < max_terms
+            if max_terms > 0:
+                # the ties are then ordered by feature name
+                full = (lengths >= max_terms).nonzero()[0]
+                threshold = scipy.empty(len(rows))
+                threshold.fill(scipy.inf)
+                threshold[full] = contributions[starts[full] + max_terms - 1]
+                keep |= contributions >= threshold.repeat(lengths)
+            features, contributions = features[keep], contributions[keep]
+            lengths = scipy.bincount(row_of[keep], minlength=len(rows))
+        feats = self.index_to_feat.take(features).tolist()
+        bounds = scipy.concatenate(([0], scipy.cumsum(lengths))).tolist()
 
-            sc = sorted(zip(feat, qi), key=lambda x: (x[1], x[0]), reverse=True)
-            total_score = qi.sum()
-            scores.append(utils._O(total_score=total_score, scores=sc[0:max_terms]))
+        scores, i = [], 0
+        for l in live:
+            if not l:
+                scores.append(utils._O(total_score=0, scores=[]))
+                continue
+            a, b = bounds[i], bounds[i+1]
+            sc = sorted(zip(feats[a:b], contributions[a:b]), key=lambda x: (x[1], x[0]), reverse=True)
+            scores.append(utils._O(total_score=totals[i], scores=sc[0:max_terms]))
+            i += 1
 
         return scores
 
@@ -184,6 +1059,11 @@ class QueryHandler(object):
             + getattr(self,'_time_taken__make_query_vector', 0)
             + getattr(self,'_time_taken__compute_scores', 0)
             + getattr(self,'_time_taken__order_indexes_by_scores', 0)
+            + getattr(self,'_time_taken__compute_sharded_scores', 0)
+            + getattr(self,'_time_taken__compute_chunked_scores', 0)
+            + getattr(self,'_time_taken__compute_candidate_scores', 0)
+            + getattr(self,'_time_taken__compute_inverted_scores', 0)
+            + getattr(self,'_time_taken__get_approximate_candidates', 0)
             + getattr(self,'_time_taken__compute_detailed_scores', 0)
         )
         
@@ -193,19 +1073,17 @@ class QueryHandler(object):
 
         This must be called after the index has been queried.
         """
+        if not self._item_ids:
+            return self.empty_results
         self._update_time_taken()
 
-        def get_tuple_item_id_score(scores):
-            # index_to_item_id[i] is numpy int, for serialization we need to convert to int
-            return [(int(self.index_to_item_id[i]), float(scores[i])) for i in self.ordered_indexes]
-            #return ((self.index_to_item_id[i], scores[i]) for i in self.ordered_indexes)
-
         return ResultSet(
             time = self.time,
             total_found = len(self.ordered_indexes),
             query_item_ids  = self.item_ids,
             _query_item_ids = self._item_ids,
-            log_scores = get_tuple_item_id_score(self.log_scores)
+            log_scores = LogScores(self.index_to_item_id.take(self.ordered_indexes), 
+                self.ordered_scores)
         )
 
     @property
@@ -213,10 +1091,77 @@ class QueryHandler(object):
         return ResultSet.get_empty_result_set(query_item_ids=self.item_ids, _query_item_ids=self._item_ids)
 
 
+class QueryContext(QueryHandler):
+    """This class holds the state of one query of a query handler.
+
+    A context is a shallow copy of the query handler made by QueryHandler.search.
+    It shares the computed index, the scorers and the caches of the handler
+    but keeps its own query items, query vector, scores and time taken.
+    """
+    def __init__(self, query_handler):
+        self.__dict__.update(vars(query_handler))
+        self.query_handler = query_handler
+        self.last_context = None
+        self.item_ids = self._item_ids = []
+
+    def new_context(self):
+        return self.query_handler.new_context()
+
+    def get_detailed_scores(self, item_ids, query_item_ids=None, max_terms=20):
+        """Returns detailed statistics about the matched items.
+
+        This will assume the items of this query unless otherwise specified
+        by 'query_item_ids'.
+        """
+        item_ids = utils.listify(item_ids)
+
+        logger.info('Computing detailed scores ...')
+        scores = self._compute_detailed_scores(item_ids, query_item_ids, max_terms)
+        
+        self._update_time_taken()
+        return scores
+
+
+class LogScores(object):
+    """The (item id, log score) couples of a ResultSet, best first.
+
+    The item ids and the log scores are kept in two arrays and the couples
+    are only made when they are read, so the results of a query returning
+    millions of items take 16 bytes per item. It behaves like a read only
+    list of couples.
+    """
+    def __init__(self, item_ids, scores):
+        self.item_ids = scipy.asarray(item_ids, dtype=scipy.int64)
+        self.scores = scipy.asarray(scores, dtype=scipy.float64)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return zip(self.item_ids[i].tolist(), self.scores[i].tolist())
+        return int(self.item_ids[i]), float(self.scores[i])
+
+    def __iter__(self):
+        # converted a block at a time
+        for start in xrange(0, len(self), 4096):
+            for couple in self[start:start+4096]:
+                yield couple
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in itertools.izip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self[:])
+
+
 class ResultSet(utils.Serializable):
     """This class represents the results returned by a query handler.
 
-    It holds the log scores amongst other variables.
+    It holds the log scores amongst other variables (see LogScores).
     """
     def __init__(self, time, total_found, query_item_ids, _query_item_ids, log_scores):
         utils.auto_assign(self, locals())
@@ -251,10 +1196,13 @@ def search(index_path, item_ids):
 def load_index(index_path, pickled=False):
     """Loads a computed index given the path to an index.
     
-    If pickled is true, load from a pickled computed index file.
+    If pickled is true, load from a pickled computed index file. If the path
+    holds a snapshot of a computed index, the snapshot is memory mapped.
     """
     if pickled:
         index = ComputedIndex.load(index_path)
+    elif ComputedIndex.is_snapshot(index_path):
+        index = ComputedIndex.load_snapshot(index_path)
     else:
         index = ComputedIndex(index_path)
     return index
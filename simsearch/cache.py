@@ -0,0 +1,91 @@
+"""This module caches the query vectors and the best results of the queries.
+
+The entries are keyed by the sorted tuple of the query item ids, so the order
+of the query items does not matter, together with the version of the computed
+index, so the entries of an updated index are never returned. The least
+recently used entries are evicted first, once there are more than max_entries
+entries or the entries take more than max_bytes bytes. If ttl is set, the
+entries also expire after ttl seconds.
+"""
+
+__all__ = ['QueryCache']
+
+import collections
+import threading
+import time
+
+# rough size of an entry without its arrays
+_ENTRY_OVERHEAD = 256
+
+
+def _sizeof(value):
+    # the bytes taken by the arrays of an entry
+    return _ENTRY_OVERHEAD + sum(getattr(v, 'nbytes', 8) for v in value)
+
+
+class QueryCache(object):
+    """A bounded LRU cache shared by all the queries of a query handler.
+
+    The counters hits, misses and evictions are kept for monitoring (see
+    stats).
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 2**20, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self):
+        """Removes all the entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get(self, key):
+        """Returns the value of the key or None if not found.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.ttl is not None and time.time() - entry[2] > self.ttl:
+                self.nbytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Caches the value, a tuple of arrays and numbers, of the key.
+
+        The value is shared by the queries, so the arrays must not be modified.
+        """
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.entries[key] = (value, size, time.time())
+            self.nbytes += size
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, size, _) = self.entries.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the counters of the cache.
+        """
+        total = self.hits + self.misses
+        return dict(entries=len(self.entries), nbytes=self.nbytes, hits=self.hits,
+            misses=self.misses, evictions=self.evictions,
+            hit_rate=float(self.hits) / total if total else 0.)
+
+    def __len__(self):
+        return len(self.entries)
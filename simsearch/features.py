@@ -0,0 +1,186 @@
+"""This module provides the iterators over the couples (item id, feature)
+which are passed to an Indexer.
+
+The features can be selected from any database following the Python DB-API
+(SQLFeatures), or read from CSV/TSV files (CSVFeatures) or from the columns
+of Parquet files (ParquetFeatures).
+
+The rows are fetched in chunks. If batches is true, the iterators return the
+arrays (item ids, features) of each chunk instead of one couple at a time,
+which the indexer then adds at once. If a value is selected as well (for a
+weighted index), the iterators return the triples (item id, feature, value)
+or the arrays (item ids, features, values). Each iterator also has a method
+partitions used by the indexer to index the features in parallel.
+"""
+
+__all__ = ['SQLFeatures', 'CSVFeatures', 'ParquetFeatures']
+
+import csv
+import copy
+import itertools
+import scipy
+
+import utils
+from utils import logger
+
+
+def _partitions(features, attr):
+    # one copy of the iterator for each value of the list attr
+    partitions = []
+    for value in getattr(features, attr):
+        partition = copy.copy(features)
+        setattr(partition, attr, [value])
+        partitions.append(partition)
+    return partitions
+
+
+def _make_batch(rows):
+    if not rows:
+        return scipy.array([], dtype=scipy.int64), scipy.array([], dtype=object)
+    columns = zip(*rows)
+    batch = scipy.array(columns[0]), scipy.array(columns[1], dtype=object)
+    if len(columns) > 2:
+        batch += (scipy.array(columns[2], dtype=scipy.float32),)
+    return batch
+
+
+class SQLFeatures(object):
+    """ Iterates over the couples (item id, feature) selected from a database.
+    """
+    def __init__(self, connect, sql_features, limit=0, chunk_size=10000, batches=False):
+        """ Takes a function returning a DB-API connection and a list of SQL
+        statements to fetch the data.
+
+        The SQL statements must select 2 fields, respectively the item id
+        and the feature, and optionally a third field with the value of the
+        feature. The rows are fetched chunk_size at a time.
+        """
+        self.connect = connect
+        self.sql_features = utils.listify(sql_features)
+        if limit:
+            self.sql_features = ['%s limit %s' % (sql, limit)
+                for sql in self.sql_features]
+        self.chunk_size = chunk_size
+        self.batches = batches
+
+    def partitions(self):
+        """ Returns one iterator for each SQL statement.
+        """
+        return _partitions(self, 'sql_features')
+
+    def __iter__(self):
+        db = self.connect()
+        try:
+            for sql in self.sql_features:
+                c = db.cursor()
+                logger.info('SQL: %s', sql)
+                c.execute(sql)
+                while True:
+                    rows = c.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    if self.batches:
+                        yield _make_batch(rows)
+                    else:
+                        for row in rows:
+                            yield tuple(row)
+                c.close()
+        finally:
+            db.close()
+
+
+class CSVFeatures(object):
+    """ Iterates over the couples (item id, feature) found in CSV or TSV files.
+
+    The features are expected to be utf8 encoded.
+    """
+    def __init__(self, paths, delimiter=',', columns=(0, 1), skip_header=False,
+        chunk_size=10000, batches=False):
+        """ Takes a list of paths to the files and the delimiter of the fields
+        (use '\\t' for TSV files).
+
+        The item id and the feature are found in the fields given by columns.
+        A third column may be given for the value of the feature.
+        """
+        self.paths = utils.listify(paths)
+        self.delimiter = delimiter
+        self.columns = columns
+        self.skip_header = skip_header
+        self.chunk_size = chunk_size
+        self.batches = batches
+
+    def partitions(self):
+        """ Returns one iterator for each file.
+        """
+        return _partitions(self, 'paths')
+
+    def __iter__(self):
+        i, j = self.columns[:2]
+        k = self.columns[2] if len(self.columns) > 2 else None
+        for path in self.paths:
+            logger.info('Reading %s ...', path)
+            with open(path, 'rb') as f:
+                reader = csv.reader(f, delimiter=self.delimiter)
+                if self.skip_header:
+                    next(reader, None)
+                while True:
+                    rows = list(itertools.islice(reader, self.chunk_size))
+                    if not rows:
+                        break
+                    if k is None:
+                        rows = [(int(row[i]), row[j]) for row in rows if row]
+                    else:
+                        rows = [(int(row[i]), row[j], float(row[k])) for row in rows if row]
+                    if self.batches:
+                        yield _make_batch(rows)
+                    else:
+                        for row in rows:
+                            yield row
+
+
+def _column_to_array(column):
+    # ChunkedArray.to_numpy only exists in recent versions of pyarrow
+    if hasattr(column, 'to_numpy'):
+        return scipy.asarray(column.to_numpy())
+    return scipy.asarray(column.to_pylist())
+
+
+class ParquetFeatures(object):
+    """ Iterates over the couples (item id, feature) stored in the columns of
+    Parquet files.
+
+    Each row group is read at once. This requires pyarrow.
+    """
+    def __init__(self, paths, id_column='id', feature_column='feature', value_column=None,
+        batches=True):
+        self.paths = utils.listify(paths)
+        self.id_column = id_column
+        self.feature_column = feature_column
+        self.value_column = value_column
+        self.batches = batches
+
+    def partitions(self):
+        """ Returns one iterator for each file.
+        """
+        return _partitions(self, 'paths')
+
+    def __iter__(self):
+        from pyarrow import parquet
+
+        columns = [self.id_column, self.feature_column]
+        if self.value_column:
+            columns.append(self.value_column)
+        for path in self.paths:
+            logger.info('Reading %s ...', path)
+            f = parquet.ParquetFile(path)
+            for i in xrange(f.num_row_groups):
+                table = f.read_row_group(i, columns=columns)
+                batch = (_column_to_array(table.column(self.id_column)),
+                    _column_to_array(table.column(self.feature_column)).astype(object))
+                if self.value_column:
+                    batch += (_column_to_array(table.column(self.value_column)).astype(scipy.float32),)
+                if self.batches:
+                    yield batch
+                else:
+                    for row in itertools.izip(batch[0].tolist(), *batch[1:]):
+                        yield row
@@ -8,78 +8,147 @@ The file .ids is used to keep track of the matrix indices with respect to
 the item ids. The line number as the index in the matrix for the given the 
 item id in the matrix. In a similar way, the file .fts is used to keep track 
 of the features.
+
+Items may be deleted from the index. The deleted items are marked in a bitmap
+stored in the file .del (one bit per line of .ids) until the index is
+compacted (see compact_index).
+
+An index may also be converted into a binary format which can be memory mapped
+(see BinaryIndex). The matrix is then stored in CSR format and the features
+are packed into a single table of utf8 bytes with their offsets.
 """
 
-__all__ = ['Indexer', 'BagOfWordsIter', 'FileIndex']
+__all__ = ['Indexer', 'BagOfWordsIter', 'FileIndex', 'BinaryIndex', 'convert_index',
+    'compact_index']
 
 import os
+import json
+import time
+import zlib
+import shutil
+import itertools
+import multiprocessing
 import scipy
 from scipy import sparse
 import codecs
-import MySQLdb
-from MySQLdb import cursors
 
+import features
 import utils
 from utils import logger
 
 
+# partitions of the features inherited by the forked workers
+_partitions = []
+
+
+def _index_partition(args):
+    i, index_path, weighted = args
+    with FileIndex(index_path, 'write', weighted=weighted) as index:
+        _add_features(index, _partitions[i])
+    return index.no_pairs
+
+
+def _add_features(index, iter_features):
+    # the iterator may return arrays of item ids and features (and values) at once
+    if getattr(iter_features, 'batches', False):
+        for batch in iter_features:
+            index.add_many(*batch)
+    else:
+        index.add_many(iter_features)
+
+
 class Indexer(object):
-    def __init__(self, index, iter_features):
+    def __init__(self, index, iter_features, processes=None):
         """ An indexer takes a FileIndex object and an iterator.
         
         The iterator must return the couple (item id, feature). The item id
         must be an integer, whereas the feature must be a unique string 
-        representing the feature (utf8 encoded or a unicode).
+        representing the feature (utf8 encoded or a unicode). If the index
+        is weighted, the iterator may return the triple (item id, feature,
+        value) instead. If the iterator has the attribute batches set to true,
+        it must return the arrays of item ids and features (and values).
+
+        If processes is set, the features are indexed in parallel. The
+        iterator must then have a method partitions returning a list of
+        iterators, or be a list of iterators itself. Each partition is indexed
+        by a worker into a partial index and the partial indexes are then
+        merged into the index.
         """
         if not isinstance(index, FileIndex):
-            self.index = FileIndex(index, 'write')
+            index = FileIndex(index, 'write')
         self.index = index
         self.iter_features = iter_features
+        self.processes = processes
         
     @utils.show_time_taken
     def index_data(self):
+        start = time.time()
         with self.index:
-            for id, feat in self.iter_features:
-                self.index.add(id, feat)
-        self.show_stats()
+            if self.processes:
+                self._index_data_in_parallel()
+            else:
+                _add_features(self.index, self.iter_features)
+        self.show_stats(time.time() - start)
+
+    def _index_data_in_parallel(self):
+        if hasattr(self.iter_features, 'partitions'):
+            partitions = self.iter_features.partitions()
+        else:
+            partitions = list(self.iter_features)
+        paths = [os.path.join(self.index.index_path, '.part-%s' % i) 
+            for i in range(len(partitions))]
+        logger.info('Indexing %s partitions with %s processes ...', 
+            len(partitions), self.processes)
+
+        _partitions[:] = partitions
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            tasks = [(i, path, self.index.weighted) for i, path in enumerate(paths)]
+            no_pairs = pool.map(_index_partition, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _partitions[:] = []
+
+        # the partial indexes are merged in order so the result is deterministic
+        for path, n in zip(paths, no_pairs):
+            logger.info('Merging partial index %s ...', path)
+            self.index.merge(FileIndex(path, 'read'))
+            self.index.no_pairs += n
+            shutil.rmtree(path)
                 
-    def show_stats(self):
+    def show_stats(self, time_taken=None):
         logger.info('Done processing the dataset.')
         logger.info('Number of items: %s', len(self.index.ids))
         logger.info('Number of features: %s', len(self.index.fts))
+        logger.info('Number of (item, feature) added: %s (%s skipped)', 
+            self.index.no_added, self.index.no_pairs - self.index.no_added)
+        if time_taken:
+            logger.info('Throughput: %.0f (item, feature) per sec.', 
+                self.index.no_pairs / time_taken)
         
 
-class BagOfWordsIter(object):
+class BagOfWordsIter(features.SQLFeatures):
     """ This class implements the bag of words model and is passed to Indexer
     object.
     """
-    def __init__(self, db_params, sql_features, limit=0):
-        """ Takes the parameters of the database (only MySQL is supported for now) 
-        and a list of SQL statements to fetch the data.
+    def __init__(self, db_params, sql_features, limit=0, chunk_size=10000, batches=False):
+        """ Takes the parameters of a MySQL database and a list of SQL 
+        statements to fetch the data. Use SQLFeatures for other databases.
         
         The SQL statements must select 2 fields, respectively the item id
         and the keyword.
         """
+        from MySQLdb import cursors
+
         self.db_params = dict(use_unicode=True, cursorclass=cursors.SSCursor)
         self.db_params.update(db_params)
-        
-        self.db = MySQLdb.connect(**self.db_params)
-        self.sql_features = sql_features        
-        if limit:
-            self.sql_features = ['%s limit %s' % (sql, limit) 
-                for sql in sql_features]
-    
-    def __iter__(self):
-        for sql in self.sql_features:
-            c = self.db.cursor()
-            logger.info('SQL: %s', sql)
-            c.execute(sql)
-            for id, feat in c:
-                if isinstance(feat, int) or isinstance(feat, long):
-                    feat = utils._unicode(feat)
-                yield id, feat
-            c.close()
-        self.db.close()
+        features.SQLFeatures.__init__(self, self._connect, sql_features, limit,
+            chunk_size, batches)
+
+    def _connect(self):
+        import MySQLdb
+        return MySQLdb.connect(**self.db_params)
 
 
 class FileIndex(object):
@@ -89,21 +158,48 @@ class FileIndex(object):
     to create the index. It will overwrite any other existing index. 
     The mode 'read' is used to load the index in memory. Finally the mode 
     'append' appends data to an already existing index.
+
+    The deleted items are found in the boolean array tombstones, indexed by
+    the matrix indices of the items.
+
+    In mode 'read', offsets may give the position in bytes to start reading
+    each file from (see ComputedIndex.update). After reading, the attribute
+    offsets holds the position of the end of each file.
+
+    A weighted index also stores a value for each (item, feature) in the file
+    .val (1 unless otherwise specified). The values are read as a float32
+    array and are weighted by the computed index (see ComputedIndex). An
+    index is weighted if created with weighted set to true in mode 'write'.
+
+    The item ids and the features read are kept in the order of the matrix
+    indices (see item_ids and features). The dicts ids and fts, which map
+    them to their indices, are only made when needed (in mode 'append').
     """
-    def __init__(self, index_path, mode='read', feat_enc='utf8'):
+    def __init__(self, index_path, mode='read', feat_enc='utf8', offsets=None, weighted=False):
         self.index_path = index_path
         self.mode = mode
-        self.ids = {}
-        self.fts = {}
+        self._ids = {}
+        self._fts = {}
+        self.offsets = dict(offsets or {})
         
         self.xco = []
         self.yco = []
-        self.X = None
+        self.values = None
+        self.keys = utils.SortedKeys()
+        self.no_pairs = 0
+        self.no_added = 0
+        self.tombstones = scipy.zeros(0, dtype=bool)
+        self._tombstones_changed = False
                 
         if mode not in ('read', 'append', 'write'):
             raise Exception('Incorrect mode %s, choose read, write \
                 or append' % self.mode)
         
+        if mode == 'write':
+            self.weighted = weighted
+        else:
+            self.weighted = os.path.exists(os.path.join(index_path, '.val'))
+
         if mode == 'read':
             self._read()
         elif mode == 'append':
@@ -112,33 +208,82 @@ class FileIndex(object):
         else:
             if not os.path.exists(index_path):
                 os.makedirs(index_path)
+            # a binary index converted from the previous index would be stale
+            BinaryIndex.remove(index_path)
+            for ext in ('del', 'val'):
+                if os.path.exists(os.path.join(index_path, '.' + ext)):
+                    os.remove(os.path.join(index_path, '.' + ext))
             self._open_index_files('write')
             
     def _read(self):
+        partial = bool(self.offsets)
         self._open_index_files(mode='read')
-        for ext in ('ids', 'fts', 'xco', 'yco'):
-            self._read_index_file(ext)
+        for ext in self._index_files:
+            self._read_index_file(ext, self.offsets.get(ext, 0))
+        if not partial:
+            self.tombstones = read_tombstones(self.index_path, len(self.item_ids))
         if self.mode == 'append':
-            self._make_coo()
+            self._make_keys()
         self._close_index_files()
     
+    @property
+    def ids(self):
+        """The dict of the item ids to their matrix indices.
+        """
+        if self._ids is None:
+            self._ids = dict((id, i) for i, id in enumerate(self._item_ids.tolist()))
+            self._item_ids = None
+        return self._ids
+
+    @property
+    def fts(self):
+        """The dict of the features to their matrix indices.
+        """
+        if self._fts is None:
+            self._fts = dict((ft, i) for i, ft in enumerate(self._features))
+            self._features = None
+        return self._fts
+
+    @property
+    def item_ids(self):
+        """The item ids as an int64 array ordered by matrix index.
+        """
+        if self._ids is None:
+            return self._item_ids
+        ids = scipy.zeros(len(self._ids), dtype=scipy.int64)
+        ids[self._ids.values()] = self._ids.keys()
+        return ids
+
+    @property
+    def features(self):
+        """The features as a list ordered by matrix index.
+        """
+        if self._fts is None:
+            return self._features
+        fts = [None] * len(self._fts)
+        for ft, i in self._fts.iteritems():
+            fts[i] = ft
+        return fts
+
     @utils.show_time_taken
-    def _make_coo(self):
-        logger.info('Making coordinate matrix for append ...')
-        data = scipy.ones(len(self.xco))
-        self.X = sparse.csr_matrix((data, (self.xco, self.yco)))
+    def _make_keys(self):
+        logger.info('Making the sorted keys of the coordinates for append ...')
+        self.keys = utils.SortedKeys(pack_keys(self.xco, self.yco))
         
-    def add(self, id, feat):
+    def add(self, id, feat, value=None):
         """ Adds the given (id, feature) to the index.
         
         The id must an int and the feature must be a unique string representation
         of the feature. The feature is expected to be unicode or utf8 encoded.
+        The value of the feature for this item is only stored in a weighted index.
         
-        This method does not check whether (id, feature) has already been inserted
+        The couple (id, feature) is skipped if it has already been inserted
         to the index.
         """
+        self.no_pairs += 1
         if not self._check_input(id, feat):
             return
+        value = self._check_value(value)
         feat = utils._unicode(feat)
         if id not in self.ids:
             x = len(self.ids)
@@ -149,21 +294,149 @@ class FileIndex(object):
             self.fts[feat] = y
             self.ffts.write('%s\n' % feat)
         (x, y) = (self.ids[id], self.fts[feat])
-        if not self._in_coo(x, y):
+        if self._add_key(x, y):
             self.fxco.write('%s\n' % x)
             self.fyco.write('%s\n' % y)
+            if self.weighted:
+                self.fval.write('%.9g\n' % value)
+            self.no_added += 1
+
+    def add_many(self, ids, feats=None, values=None, buffer_size=1000000):
+        """ Adds many (id, feature) to the index at once.
+
+        Either ids and feats are two sequences (or arrays) of the same length,
+        or ids is an iterable over the couples (id, feature) and feats is None.
+        The values are given in the same way, as a third sequence or as the
+        triples (id, feature, value).
+
+        The couples are processed in blocks of buffer_size. The ids and the
+        features of a block are looked up once per distinct value and the
+        coordinates of a block are written to the index files at once.
+        """
+        if self.mode == 'read':
+            raise Exception('Can\'t write to read only index!')
+        if feats is None:
+            pairs = iter(ids)
+            while True:
+                block = list(itertools.islice(pairs, buffer_size))
+                if not block:
+                    break
+                self._add_block(*zip(*block))
+        else:
+            for i in xrange(0, len(ids), buffer_size):
+                self._add_block(ids[i:i+buffer_size], feats[i:i+buffer_size],
+                    None if values is None else values[i:i+buffer_size])
+
+    def _add_block(self, ids, feats, values=None):
+        self.no_pairs += len(ids)
+        ids = scipy.asarray(ids)
+        feats = scipy.asarray(feats, dtype=object)
+        values = self._check_values(values, len(ids))
+        if ids.dtype.kind not in 'iu':
+            defined = scipy.array([id is not None and feat is not None 
+                for id, feat in zip(ids, feats)], dtype=bool)
+            if not defined.all():
+                logger.warn('%s undefined item ids or features ... skipping.', (~defined).sum())
+            ids = scipy.array(ids[defined].tolist())
+            feats = feats[defined]
+            if values is not None:
+                values = values[defined]
+            if len(ids) and ids.dtype.kind not in 'iu':
+                raise Exception('List of ids must be integers!')
+        if not len(ids):
+            return
+
+        x = self._intern(ids, self.ids, self.fids, int)
+        y = self._intern(feats, self.fts, self.ffts, utils._unicode)
+        self._add_coordinates(x, y, values)
+
+    def merge(self, index):
+        """ Merges another index into this index.
+
+        The ids and the features of the other index are mapped to the
+        indices of this index, and the coordinates are then remapped at once.
+        """
+        if self.mode == 'read':
+            raise Exception('Can\'t write to read only index!')
+        ids, features = index.item_ids, index.features
+        fts = scipy.empty(len(features), dtype=object)
+        fts[:] = features
+
+        x = self._intern(ids, self.ids, self.fids, int)
+        y = self._intern(fts, self.fts, self.ffts, utils._unicode)
+        self._add_coordinates(x[index.xco], y[index.yco], index.values)
+
+    def _add_coordinates(self, x, y, values=None):
+        # skip the coordinates already in the index or repeated in the block
+        keys = pack_keys(x, y)
+        keys, first = scipy.unique(keys, return_index=True)
+        new = ~self.keys.contains(keys)
+        first = scipy.sort(first[new])
+        self.keys.add_block(keys[new])
+        x, y = x[first], y[first]
+
+        if len(x):
+            self.fxco.write('\n'.join(map(str, x.tolist())) + '\n')
+            self.fyco.write('\n'.join(map(str, y.tolist())) + '\n')
+            if self.weighted:
+                values = scipy.ones(len(x)) if values is None else values[first]
+                self.fval.write('\n'.join('%.9g' % v for v in values.tolist()) + '\n')
+        self.no_added += len(x)
+
+    def _intern(self, values, indices, f, convert):
+        # returns the indices of the values, new values are added to the index
+        if values.dtype.kind == 'O':
+            # hashing is much faster than sorting python objects
+            codes = {}
+            inverse = scipy.array([codes.setdefault(v, len(codes)) for v in values.tolist()],
+                dtype=scipy.int64)
+            uniq = sorted(codes, key=codes.get)
+        else:
+            uniq, inverse = scipy.unique(values, return_inverse=True)
+            uniq = uniq.tolist()
+        uniq_indices = scipy.zeros(len(uniq), dtype=scipy.int64)
+        new = []
+        for i, v in enumerate(uniq):
+            v = convert(v)
+            if v not in indices:
+                indices[v] = len(indices)
+                new.append(v)
+            uniq_indices[i] = indices[v]
+        if new:
+            f.write(''.join('%s\n' % v for v in new))
+        return uniq_indices[inverse]
     
+    def delete(self, id):
+        """ Marks the given item id as deleted.
+
+        The item is kept in the index files but it will no longer be scored
+        nor returned by a computed index. The item is removed for good when
+        the index is compacted.
+        """
+        if self.mode == 'read':
+            raise Exception('Can\'t write to read only index!')
+        if id not in self.ids:
+            logger.warn('Item %s is not in the index ... skipping.', id)
+            return
+        if len(self.tombstones) < len(self.ids):
+            self.tombstones = scipy.concatenate((self.tombstones,
+                scipy.zeros(len(self.ids) - len(self.tombstones), dtype=bool)))
+        self.tombstones[self.ids[id]] = True
+        self._tombstones_changed = True
+
     def close(self):
         self._close_index_files()
+        if self._tombstones_changed:
+            write_tombstones(self.index_path, self.tombstones)
+            self._tombstones_changed = False
     
-    def _in_coo(self, x, y):
-        in_coo = False
-        if self.mode == 'append':
-            try:
-                in_coo = bool(self.X[x, y])
-            except IndexError:
-                pass
-        return in_coo
+    def _add_key(self, x, y):
+        # the coordinates are kept as 64 bit keys, returns False if (x, y) is found
+        key = (x << 32) | y
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
                 
     def _check_input(self, id, feat):
         success = False
@@ -181,16 +454,35 @@ class FileIndex(object):
         else:
             success = True
         return success
+
+    def _check_value(self, value):
+        if value is None:
+            return 1.0
+        if not self.weighted:
+            raise Exception('Can\'t store values in an index which is not weighted!')
+        return value
+
+    def _check_values(self, values, size):
+        if values is None:
+            return None
+        if not self.weighted:
+            raise Exception('Can\'t store values in an index which is not weighted!')
+        values = scipy.array([1.0 if v is None else v for v in values], dtype=scipy.float32)
+        if len(values) != size:
+            raise Exception('There must be one value for each (id, feature)!')
+        return values
+
+    @property
+    def _index_files(self):
+        return ('ids', 'fts', 'xco', 'yco') + (('val',) if self.weighted else ())
     
     def _open_index_files(self, mode='read'):
         mode = dict(write='wb', append='ab', read='rb')[mode]
-        self.fxco = self._new_index_file_handle('xco', mode)
-        self.fyco = self._new_index_file_handle('yco', mode)
-        self.fids = self._new_index_file_handle('ids', mode)
-        self.ffts = self._new_index_file_handle('fts', mode)
+        for ext in self._index_files:
+            setattr(self, 'f' + ext, self._new_index_file_handle(ext, mode))
     
     def _close_index_files(self):
-        for f in ('fxco', 'fyco', 'fids', 'ffts'):
+        for f in ('fxco', 'fyco', 'fids', 'ffts', 'fval'):
             if hasattr(self, f):
                 getattr(self, f).close()
     
@@ -201,19 +493,262 @@ class FileIndex(object):
             return open(os.path.join(self.index_path, '.'+ext), mode)
         
     @utils.show_time_taken
-    def _read_index_file(self, ext):
+    def _read_index_file(self, ext, offset=0):
         f = self.__dict__['f'+ext]
         logger.info('Reading file %s ...' % f.name)
+        f.seek(offset)
         if ext == 'fts':
-            vals = f.read().split('\n')[:-1]
+            self._features, self._fts = f.read().split('\n')[:-1], None
+        elif ext == 'ids':
+            self._item_ids, self._ids = scipy.fromfile(f, sep='\n', dtype=scipy.int64), None
+        elif ext == 'val':
+            self.values = scipy.fromfile(f, sep='\n', dtype=scipy.float32)
         else:
-            vals = scipy.fromfile(f, sep='\n', dtype=scipy.int32)
-        if ext == 'fts' or ext == 'ids':
-            vals = dict((v, i) for i, v in enumerate(vals))
-        self.__dict__[ext] = vals
+            self.__dict__[ext] = scipy.fromfile(f, sep='\n', dtype=scipy.int32)
+        self.offsets[ext] = f.tell()
            
     def __enter__(self):
         return self
     
     def __exit__(self, type, value, traceback):
-        self._close_index_files()
+        self.close()
+
+
+def pack_keys(xco, yco):
+    """ Packs the coordinates (x, y) into 64 bit integer keys.
+    """
+    return (scipy.asarray(xco, dtype=scipy.int64) << 32) | scipy.asarray(yco, dtype=scipy.int64)
+
+
+def read_tombstones(index_path, no_items):
+    """ Returns a boolean array marking the deleted items of the index.
+    """
+    deleted = scipy.zeros(no_items, dtype=bool)
+    path = os.path.join(index_path, '.del')
+    if os.path.exists(path):
+        bits = scipy.unpackbits(scipy.fromfile(path, dtype=scipy.uint8))[:no_items]
+        deleted[:len(bits)] = bits
+    return deleted
+
+
+def text_index_checksums(index_path, offsets):
+    """ Returns the checksums of the beginning of each file of the index,
+    up to the given offsets.
+    """
+    checksums = {}
+    for ext, offset in offsets.items():
+        with open(os.path.join(index_path, '.' + ext), 'rb') as f:
+            checksums[ext] = zlib.crc32(f.read(min(offset, 2**16))) & 0xffffffff
+    return checksums
+
+
+def text_index_changes(header):
+    """ Returns how the text index a binary index was converted from has
+    changed since: None if it has not changed (or is not found), 'appended'
+    if entries were appended to it, or 'rewritten' otherwise.
+    """
+    index_path, offsets = header.get('text_index_path'), header.get('text_offsets')
+    if not index_path or not offsets or not os.path.exists(os.path.join(index_path, '.ids')):
+        return None
+    paths = dict((ext, os.path.join(index_path, '.' + ext)) for ext in offsets)
+    if not all(os.path.exists(path) for path in paths.values()):
+        return 'rewritten'
+    sizes = dict((ext, os.path.getsize(path)) for ext, path in paths.items())
+    if any(sizes[ext] < offset for ext, offset in offsets.items()):
+        return 'rewritten'
+    checksums = header.get('text_checksums')
+    if checksums is not None and text_index_checksums(index_path, offsets) != checksums:
+        return 'rewritten'
+    if sizes != offsets:
+        return 'appended'
+    return None
+
+
+def write_tombstones(index_path, deleted):
+    """ Writes the bitmap of the deleted items of the index.
+    """
+    scipy.packbits(deleted).tofile(os.path.join(index_path, '.del'))
+
+
+class BinaryIndex(object):
+    """ This class is used to read or write an index in the binary format.
+
+    The binary format is made of the following files:
+
+        .header         : format version and the size of the index (json)
+        .ids.npy        : the item id of each row (int64)
+        .ids_order.npy  : the rows sorted by item id (int64)
+        .indptr.npy     : the CSR row pointers of the matrix
+        .indices.npy    : the CSR column indices of the matrix
+        .fts_offsets.npy: the offsets of each feature in .fts_data.npy (int64)
+        .fts_data.npy   : the utf8 encoded features packed together (uint8)
+        .values.npy     : the CSR values of a weighted index (float32, optional)
+
+    The CSR arrays are int32 unless the number of non zero elements requires
+    int64. All the arrays are loaded with numpy.memmap so opening an index is
+    almost instantaneous and the pages are shared amongst processes.
+
+    Additional arrays may be stored along with the index. They are listed in
+    the header and loaded as attributes of the same name.
+    """
+    VERSION = 1
+    ARRAYS = ('ids', 'ids_order', 'indptr', 'indices', 'fts_offsets', 'fts_data')
+
+    def __init__(self, index_path, mmap=True):
+        self.index_path = index_path
+        self.header = self.read_header(index_path)
+        if self.header.get('version') != self.VERSION:
+            raise Exception('Unsupported binary index version %s' % self.header.get('version'))
+        mmap_mode = 'r' if mmap else None
+        for name in self.array_names:
+            setattr(self, name, scipy.load(self._path(name + '.npy'), mmap_mode=mmap_mode))
+        self.fts = utils.StringTable(self.fts_offsets, self.fts_data)
+        self.no_items = self.header['no_items']
+        self.no_features = self.header['no_features']
+
+    @staticmethod
+    def exists(index_path):
+        """ Returns whether a binary index is found in the given path.
+        """
+        return os.path.exists(os.path.join(index_path, '.header'))
+
+    @staticmethod
+    def remove(index_path):
+        """ Removes the binary index found in the given path, if any.
+        """
+        if not BinaryIndex.exists(index_path):
+            return
+        header = BinaryIndex.read_header(index_path)
+        os.remove(os.path.join(index_path, '.header'))
+        for name in BinaryIndex.ARRAYS + tuple(header.get('arrays', [])):
+            path = os.path.join(index_path, '.%s.npy' % name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def array_names(self):
+        return self.ARRAYS + tuple(self.header.get('arrays', []))
+
+    @staticmethod
+    def write(index_path, ids, X, fts, arrays=None, **header):
+        """ Writes a binary index given the item ids of each row, the matrix
+        in CSR format and the features of each column.
+
+        The dictionary arrays holds any additional arrays to store and the
+        keyword arguments are added to the header. If the header gives the
+        text index converted and its offsets, the checksums of the text index
+        are added as well (see text_index_changes).
+        """
+        logger.info('Writing binary index in %s ...', index_path)
+        if not os.path.exists(index_path):
+            os.makedirs(index_path)
+        X = X.tocsr()
+        X.sum_duplicates()
+        ids = scipy.asarray(ids, dtype=scipy.int64)
+        dtype = scipy.int32 if X.nnz < 2**31 and X.shape[1] < 2**31 else scipy.int64
+        if not isinstance(fts, utils.StringTable):
+            fts = utils.StringTable.from_strings(fts)
+
+        extra = arrays or {}
+        arrays = dict(extra,
+            ids = ids,
+            ids_order = ids.argsort(kind='mergesort'),
+            indptr = X.indptr.astype(dtype),
+            indices = X.indices.astype(dtype),
+            fts_offsets = scipy.asarray(fts.offsets, dtype=scipy.int64),
+            fts_data = scipy.asarray(fts.data, dtype=scipy.uint8))
+        for name, arr in arrays.iteritems():
+            scipy.save(os.path.join(index_path, '.%s.npy' % name), arr)
+
+        if header.get('text_offsets') and os.path.exists(os.path.join(header.get('text_index_path') or '', '.ids')):
+            header['text_checksums'] = text_index_checksums(header['text_index_path'],
+                header['text_offsets'])
+        header.update(version=BinaryIndex.VERSION, no_items=X.shape[0],
+            no_features=X.shape[1], nnz=X.nnz, index_dtype=scipy.dtype(dtype).name,
+            arrays=sorted(extra))
+        with open(os.path.join(index_path, '.header'), 'wb') as f:
+            json.dump(header, f)
+
+    @staticmethod
+    def read_header(index_path):
+        """ Returns the header of the binary index found in the given path.
+        """
+        with open(os.path.join(index_path, '.header'), 'rb') as f:
+            return json.load(f)
+
+    def _path(self, name):
+        return os.path.join(self.index_path, '.' + name)
+
+    def close(self):
+        for name in self.array_names:
+            if hasattr(self, name):
+                delattr(self, name)
+
+
+def convert_index(index_path, out_path=None):
+    """ Converts an index in the text format into the binary format.
+
+    The binary index is written in out_path or alongside the text index
+    if out_path is not specified.
+    """
+    index = FileIndex(index_path, mode='read')
+    logger.info('Converting index %s ...', index_path)
+    ids, fts = index.item_ids, index.features
+    data = index.values if index.weighted else scipy.ones(len(index.xco), dtype=scipy.int8)
+    X = sparse.csr_matrix((data, (index.xco, index.yco)), shape=(len(ids), len(fts)))
+    arrays = dict(deleted=index.tombstones) if index.tombstones.any() else {}
+    if index.weighted:
+        X.sum_duplicates()
+        arrays['values'] = X.data.astype(scipy.float32)
+    BinaryIndex.write(out_path or index_path, ids, X, fts, arrays,
+        text_index_path=index_path, text_offsets=index.offsets)
+    index.close()
+
+
+def compact_index(index_path, max_deleted_ratio=0.1):
+    """ Rewrites the index without the deleted items if the ratio of deleted
+    items exceeds max_deleted_ratio.
+
+    The features no longer found in any item are removed as well. Any binary
+    index found in the same path is converted again. The computed indexes
+    of this index must be created again once the index is compacted.
+
+    Returns whether the index has been compacted.
+    """
+    index = FileIndex(index_path, mode='read')
+    deleted = index.tombstones
+    ratio = deleted.sum() / float(max(len(deleted), 1))
+    if ratio <= max_deleted_ratio:
+        logger.info('Only %.2f%% of the items are deleted ... skipping.', 100 * ratio)
+        return False
+    logger.info('Compacting index %s (%.2f%% deleted) ...', index_path, 100 * ratio)
+
+    ids, fts = index.item_ids, index.features
+
+    live = ~deleted
+    xco, yco = scipy.asarray(index.xco), scipy.asarray(index.yco)
+    keep = live[xco]
+    xco, yco = xco[keep], yco[keep]
+    values = index.values[keep] if index.weighted else None
+    used = scipy.zeros(len(fts), dtype=bool)
+    used[yco] = True
+
+    # new indices of the remaining items and features
+    xco = (scipy.cumsum(live) - 1)[xco]
+    yco = (scipy.cumsum(used) - 1)[yco]
+    ids = ids[live]
+    fts = [fts[i] for i in used.nonzero()[0]]
+
+    # the binary index is removed when the text index is rewritten
+    binary = BinaryIndex.exists(index_path)
+    with FileIndex(index_path, mode='write', weighted=values is not None) as index:
+        index.fids.write(''.join('%s\n' % id for id in ids))
+        index.ffts.write(u''.join(u'%s\n' % ft for ft in fts))
+        index.fxco.write(''.join('%s\n' % x for x in xco))
+        index.fyco.write(''.join('%s\n' % y for y in yco))
+        if values is not None:
+            index.fval.write(''.join('%.9g\n' % v for v in values.tolist()))
+
+    if binary:
+        convert_index(index_path)
+    return True
@@ -0,0 +1,115 @@
+"""This module scores the items from an inverted view of the matrix.
+
+The query vector of N query items only differs from the query vector of N
+items without any feature (the baseline) on the features of the query items.
+The log scores are then the baseline scores plus the contributions of the
+features of the query items, which are added by visiting the columns of
+these features only.
+
+The baseline scores and their order are computed once for each number of
+query items. The best items are found amongst the items sharing a feature
+with the query items and the best items of the baseline.
+"""
+
+__all__ = ['InvertedScorer']
+
+import scipy
+
+import utils
+from utils import logger
+
+
+class InvertedScorer(object):
+    """Computes the best log scores of a computed index from the columns of
+    the matrix in CSC format.
+
+    Note that the matrix is copied into the CSC format.
+    """
+    def __init__(self, computed_index):
+        logger.info('Creating the inverted view of the matrix ...')
+        self.X = computed_index.X.tocsc()
+        self.binary = computed_index.weighting == 'binary'
+        self.deleted = computed_index.deleted
+        self._baselines = {}
+
+    def _get_baseline(self, N, q0):
+        # the scores of the items for the baseline query vector q0 of N items
+        baseline = self._baselines.get(N)
+        if baseline is None:
+            logger.info('Computing the baseline scores of %s items ...', N)
+            scores = scipy.asarray(self.X * q0, dtype=scipy.float64).ravel()
+            if self.deleted is not None:
+                scores[self.deleted] = -scipy.inf
+            baseline = scores, scipy.argsort(-scores, kind='mergesort')
+            # the cache may be shared by concurrent queries
+            if len(self._baselines) >= 8:
+                self._baselines.clear()
+            self._baselines[N] = baseline
+        return baseline
+
+    def score(self, c, best_k, N, q0, features, values, min_score=None):
+        """Returns the indexes and the log scores of the best k items given
+        the constant c and the query vector of N items.
+
+        The query vector is the baseline query vector q0 of N items except
+        for the given values on the given features. If best_k is -1, the log
+        scores of all the items are returned. If min_score is set, only the
+        items with a log score of at least min_score are returned.
+        """
+        scores, order = self._get_baseline(N, q0)
+        delta = values - q0[features]
+
+        # the non zero elements of the columns of the features
+        positions, lengths = utils.slice_positions(self.X.indptr, features)
+        rows = self.X.indices[positions]
+        weights = delta.repeat(lengths)
+        if not self.binary:
+            weights *= self.X.data[positions]
+        if len(rows) > len(scores) / 8:
+            # many items are visited, summing over all the items is faster than sorting
+            touched = scipy.bincount(rows, minlength=len(scores)).nonzero()[0]
+            touched_scores = scores[touched] + scipy.bincount(rows, weights=weights,
+                minlength=len(scores))[touched]
+        else:
+            touched, inverse = scipy.unique(rows, return_inverse=True)
+            touched_scores = scores[touched] + scipy.bincount(inverse, weights=weights,
+                minlength=len(touched))
+        logger.info('Visited %s items sharing a feature with the query items ...', len(touched))
+
+        if best_k == -1:
+            log_scores = c + scores
+            log_scores[touched] = c + touched_scores
+            indexes = scipy.arange(len(log_scores))
+        else:
+            best = utils.argsort_best(touched_scores, best_k, reverse=True)
+            others = self._get_best_others(order, touched, best_k)
+            indexes = scipy.concatenate((touched[best], others))
+            log_scores = c + scipy.concatenate((touched_scores[best], scores[others]))
+
+            # ties are broken by smallest index
+            by_index = scipy.argsort(indexes, kind='mergesort')
+            indexes, log_scores = indexes[by_index], log_scores[by_index]
+            best = utils.argsort_best(log_scores, best_k, reverse=True)
+            indexes, log_scores = indexes[best], log_scores[best]
+
+        if self.deleted is not None:
+            live = ~self.deleted[indexes]
+            indexes, log_scores = indexes[live], log_scores[live]
+        if min_score is not None:
+            # the best items above the threshold are the best items which are above it
+            above = log_scores >= min_score
+            indexes, log_scores = indexes[above], log_scores[above]
+        return indexes, log_scores
+
+    @staticmethod
+    def _get_best_others(order, touched, best_k):
+        # the first best_k items of the baseline order which were not visited
+        size = 2 * best_k
+        while True:
+            others = order[:size]
+            pos = touched.searchsorted(others).clip(0, max(len(touched) - 1, 0))
+            if len(touched):
+                others = others[touched[pos] != others]
+            if len(others) >= best_k or size >= len(order):
+                return others[:best_k]
+            size *= 4
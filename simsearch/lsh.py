@@ -0,0 +1,97 @@
+"""This module generates candidate items with locality sensitive hashing.
+
+The features of each item are hashed into a MinHash signature. The signature
+is split into bands of a few rows and the items are bucketed by the hash of
+each band. The items which share a bucket with a query item are likely to
+share many of its features and are returned as candidates. The candidates are
+then scored exactly by the query handler.
+
+More bands find more candidates (higher recall, slower) whereas more rows
+per band find fewer but more similar candidates.
+"""
+
+__all__ = ['MinHashLSH']
+
+import scipy
+
+import utils
+from utils import logger
+
+# the hash functions are (a * feature + b) mod a Mersenne prime
+_PRIME = 2**31 - 1
+
+
+class MinHashLSH(object):
+    """Finds the items sharing a band of their MinHash signatures with the
+    query items.
+
+    The buckets of each band are kept as the keys of the items sorted
+    together with the order of the items, so this takes about 12 bytes
+    per item and per band.
+    """
+    def __init__(self, computed_index, no_bands=16, rows_per_band=4, seed=0):
+        self.X = computed_index.X
+        self.no_bands = no_bands
+        self.rows_per_band = rows_per_band
+        self.seed = seed
+
+        r = scipy.random.RandomState(seed)
+        no_hashes = no_bands * rows_per_band
+        self.a = r.randint(1, _PRIME, no_hashes).astype(scipy.int64)
+        self.b = r.randint(0, _PRIME, no_hashes).astype(scipy.int64)
+        self.multipliers = r.randint(1, 2**62, rows_per_band).astype(scipy.uint64) | scipy.uint64(1)
+        self._make_buckets()
+
+    @utils.show_time_taken
+    def _make_buckets(self):
+        logger.info('Hashing %s items into %s bands of %s rows ...', self.X.shape[0],
+            self.no_bands, self.rows_per_band)
+        dtype = scipy.int32 if self.X.shape[0] < 2**31 else scipy.int64
+        self.keys, self.orders = [], []
+        for band in xrange(self.no_bands):
+            keys = self._band_keys(self._signatures(self.X.indptr, self.X.indices, band))
+            order = keys.argsort(kind='mergesort')
+            self.keys.append(keys[order])
+            self.orders.append(order.astype(dtype))
+
+    def _signatures(self, indptr, indices, band=None):
+        # the MinHash signatures of the rows, for one band or for all the bands
+        if band is None:
+            a, b = self.a, self.b
+        else:
+            a = self.a[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            b = self.b[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+        non_empty = scipy.diff(indptr) > 0
+        signatures = scipy.empty((len(indptr) - 1, len(a)), dtype=scipy.int64)
+        signatures.fill(_PRIME)
+        if non_empty.any():
+            indices = scipy.asarray(indices, dtype=scipy.int64)
+            starts = scipy.asarray(indptr[:-1], dtype=scipy.int64)[non_empty]
+            for k in xrange(len(a)):
+                hashes = (a[k] * indices + b[k]) % _PRIME
+                signatures[non_empty,k] = scipy.minimum.reduceat(hashes, starts)
+        return signatures
+
+    def _band_keys(self, signatures):
+        # the hash of the rows of the signatures in a band
+        keys = scipy.zeros(len(signatures), dtype=scipy.uint64)
+        for row in xrange(self.rows_per_band):
+            keys = (keys ^ signatures[:,row].astype(scipy.uint64)) * self.multipliers[row]
+        return keys
+
+    def get_candidates(self, rows):
+        """Returns the sorted rows of the items sharing a bucket with the items
+        of the given rows (included).
+        """
+        rows = scipy.asarray(rows, dtype=scipy.int64)
+        positions, lengths = utils.slice_positions(self.X.indptr, rows)
+        indptr = scipy.concatenate(([0], scipy.cumsum(lengths)))
+        signatures = self._signatures(indptr, self.X.indices[positions])[lengths > 0]
+
+        candidates = [rows]
+        for band in xrange(self.no_bands):
+            keys = self._band_keys(signatures[:,band * self.rows_per_band:])
+            starts = self.keys[band].searchsorted(keys, 'left')
+            ends = self.keys[band].searchsorted(keys, 'right')
+            candidates.extend(self.orders[band][s:e] for s, e in zip(starts, ends))
+        return scipy.unique(scipy.concatenate(candidates))
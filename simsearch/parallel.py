@@ -0,0 +1,134 @@
+"""This module distributes the computation of the log scores over several
+processes.
+
+The rows of the matrix are split into shards of about the same number of non
+zero elements. Each worker computes the log scores of a shard together with
+its best k items, and the partial results are then merged.
+
+The workers are forked after the computed index is loaded, so the matrix is
+shared with the workers (copy on write, or page sharing if the index is memory
+mapped) and is never pickled. The query vector is passed through shared memory.
+"""
+
+__all__ = ['ShardedScorer']
+
+import itertools
+import threading
+import multiprocessing
+import scipy
+from scipy import sparse
+
+import utils
+from utils import logger
+
+# registry of the matrices and query vectors shared with the forked workers
+_shared = {}
+_tokens = itertools.count()
+
+# shards of the matrix already built by a worker
+_shards = {}
+
+
+def _slice_rows(X, start, end):
+    # the rows of the shard, the arrays are views and are not copied
+    a, b = X.indptr[start], X.indptr[end]
+    return sparse.csr_matrix((X.data[a:b], X.indices[a:b], X.indptr[start:end+1] - a),
+        shape=(end - start, X.shape[1]))
+
+
+def _get_shard(token, start, end):
+    key = (token, start, end)
+    if key not in _shards:
+        _shards[key] = _slice_rows(_shared[token][0], start, end)
+    return _shards[key]
+
+
+def _score_shard(args, shared=None):
+    # shared is only given when the shard is scored outside of the workers
+    token, start, end, c, best_k, min_score = args
+    X, q, deleted = shared or _shared[token]
+    q = scipy.frombuffer(q, dtype=X.dtype)
+    shard = _get_shard(token, start, end) if shared is None else _slice_rows(X, start, end)
+    # the constant is added in float64 whatever the dtype of the matrix
+    log_scores = (shard * q).astype(scipy.float64)
+    log_scores += c
+    if deleted is not None:
+        deleted = deleted[start:end]
+        log_scores[deleted] = -scipy.inf
+    rows = scipy.arange(len(log_scores))
+    if min_score is not None:
+        rows = (log_scores >= min_score).nonzero()[0]
+    if best_k == -1:
+        best = rows
+    else:
+        best = rows[utils.argsort_best(log_scores[rows], best_k, reverse=True)]
+    if deleted is not None:
+        best = best[~deleted[best]]
+    return best + start, log_scores[best]
+
+
+class ShardedScorer(object):
+    """Computes the best log scores of a computed index with a pool of processes.
+
+    The matrix is split into one shard per process unless otherwise specified
+    by no_shards.
+
+    The scorer may still be used by the contexts of the queries in flight when
+    it is closed (see QueryHandler.refresh). So the pool is only terminated
+    once no shard is being scored, and the shards of a query made after that
+    are scored in the calling thread.
+    """
+    def __init__(self, computed_index, processes=None, no_shards=None):
+        X = computed_index.X
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shards = self._split(X, no_shards or self.processes)
+
+        self.token = _tokens.next()
+        self.q = multiprocessing.RawArray('f' if X.dtype == scipy.float32 else 'd', X.shape[1])
+        self.dtype = X.dtype
+        self.shared = (X, self.q, computed_index.deleted)
+        _shared[self.token] = self.shared
+        self.pool = multiprocessing.Pool(self.processes)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _split(X, no_shards):
+        # row ranges with about the same number of non zero elements
+        targets = scipy.linspace(0, X.nnz, no_shards + 1)[1:-1]
+        bounds = scipy.unique(scipy.concatenate((
+            [0], X.indptr.searchsorted(targets), [X.shape[0]])))
+        return zip(bounds[:-1], bounds[1:])
+
+    def score(self, q, c, best_k=100, min_score=None):
+        """Returns the indexes and the log scores of the best k items given
+        the query vector q and the constant c.
+
+        If best_k is -1, the log scores of all the items are returned. If
+        min_score is set, the items with a lower log score are left out by
+        the workers.
+        """
+        with self.lock:
+            scipy.frombuffer(self.q, dtype=self.dtype)[:] = scipy.asarray(q).ravel()
+            tasks = [(self.token, start, end, c, best_k, min_score) for start, end in self.shards]
+            if self.pool is None:
+                partial = [_score_shard(task, self.shared) for task in tasks]
+            else:
+                partial = self.pool.map(_score_shard, tasks)
+
+        # shards are in row order so ties keep being broken by smallest index
+        indexes = scipy.concatenate([p[0] for p in partial])
+        log_scores = scipy.concatenate([p[1] for p in partial])
+        if best_k != -1:
+            best = utils.argsort_best(log_scores, best_k, reverse=True)
+            indexes, log_scores = indexes[best], log_scores[best]
+        logger.info('Merged %s shards ...', len(partial))
+        return indexes, log_scores
+
+    def close(self):
+        """Terminates the pool of processes, once the shards being scored are done.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            _shared.pop(self.token, None)
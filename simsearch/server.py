@@ -0,0 +1,411 @@
+"""This module serves the queries of a computed index over the network.
+
+The computed index is loaded once by the server and the requests of many
+processes are answered by one query handler, each request in its own thread
+(see bsets.QueryContext). Two protocols are served:
+
+    HTTP/JSON : POST the JSON parameters to /query, /query_batch or
+                /detailed_scores and read the JSON results. GET /stats
+                returns the size of the index and the counters of the cache.
+    binary    : length prefixed frames over a persistent TCP connection.
+                The item ids and the log scores are sent as arrays of 64 bits
+                integers and floats. The requests can be pipelined, the
+                responses come back in the same order.
+
+A QueryClient speaks either protocol and returns the same objects as the
+query handler.
+"""
+
+__all__ = ['QueryServer', 'QueryClient']
+
+import json
+import httplib
+import socket
+import struct
+import threading
+import BaseHTTPServer
+import SocketServer
+import scipy
+
+import bsets
+import utils
+from utils import logger
+
+# a frame is the operation, the length of the body and the body
+_HEADER = struct.Struct('!BI')
+ERROR, QUERY, QUERY_BATCH, DETAILED_SCORES = range(4)
+_METHODS = {QUERY: 'query', QUERY_BATCH: 'query_batch', DETAILED_SCORES: 'detailed_scores'}
+_OPS = dict((method, op) for op, method in _METHODS.items())
+
+
+def _check_candidate_ids(candidate_ids):
+    # the binary protocol sends the candidates as item ids, so a bitmap of the
+    # candidate rows is refused by both protocols
+    candidate_ids = scipy.asarray(candidate_ids)
+    if candidate_ids.dtype == bool:
+        raise ValueError('The candidates must be item ids, not a bitmap of the candidate rows')
+    return candidate_ids
+
+
+def _dispatch(query_handler, method, params):
+    # the parameters and the results are the same for both protocols
+    if method == 'query':
+        candidate_ids = params.get('candidate_ids')
+        if candidate_ids is not None:
+            candidate_ids = _check_candidate_ids(candidate_ids)
+        return query_handler.search(params['item_ids'], params.get('max_results', 100),
+            candidate_ids, params.get('min_score'),
+            params.get('positive_only', False)).results
+    elif method == 'query_batch':
+        return query_handler.query_batch(params['item_ids_list'], params.get('max_results', 100))
+    elif method == 'detailed_scores':
+        return query_handler.new_context().get_detailed_scores(params['item_ids'],
+            params['query_item_ids'], params.get('max_terms', 20))
+    raise Exception('Unknown method %s' % method)
+
+
+def _pack_ids(ids):
+    ids = scipy.asarray(ids, dtype='>i8')
+    return struct.pack('!I', len(ids)) + ids.tostring()
+
+
+def _unpack_ids(data, offset):
+    n, = struct.unpack_from('!I', data, offset)
+    offset += 4
+    return scipy.frombuffer(data, '>i8', n, offset), offset + 8 * n
+
+
+def _pack_results(results):
+    log_scores = results.log_scores
+    if not isinstance(log_scores, bsets.LogScores):
+        log_scores = bsets.LogScores([id for id, sc in log_scores], [sc for id, sc in log_scores])
+    ids, scores = log_scores.item_ids, log_scores.scores.astype('>f8')
+    return (struct.pack('!dI', results.time, results.total_found) + _pack_ids(results.query_item_ids)
+        + _pack_ids(results._query_item_ids) + _pack_ids(ids) + scores.tostring())
+
+
+def _unpack_results(data, offset):
+    time, total_found = struct.unpack_from('!dI', data, offset)
+    query_item_ids, offset = _unpack_ids(data, offset + 12)
+    _query_item_ids, offset = _unpack_ids(data, offset)
+    ids, offset = _unpack_ids(data, offset)
+    scores = scipy.frombuffer(data, '>f8', len(ids), offset)
+    return bsets.ResultSet(time, total_found, query_item_ids.tolist(), _query_item_ids.tolist(),
+        bsets.LogScores(ids, scores)), offset + 8 * len(ids)
+
+
+def _encode_request(method, params):
+    if method == 'query':
+        body = struct.pack('!i', params.get('max_results', 100)) + _pack_ids(params['item_ids'])
+        candidate_ids = params.get('candidate_ids')
+        if candidate_ids is None:
+            body += struct.pack('!B', 0)
+        else:
+            body += struct.pack('!B', 1) + _pack_ids(_check_candidate_ids(candidate_ids))
+        # no minimum score is sent as nan
+        min_score = params.get('min_score')
+        body += struct.pack('!dB', scipy.nan if min_score is None else min_score,
+            bool(params.get('positive_only')))
+    elif method == 'query_batch':
+        item_ids_list = params['item_ids_list']
+        body = struct.pack('!iI', params.get('max_results', 100), len(item_ids_list))
+        body += ''.join(_pack_ids(item_ids) for item_ids in item_ids_list)
+    else:
+        body = json.dumps(params)
+    return _HEADER.pack(_OPS[method], len(body)) + body
+
+
+def _decode_request(op, body):
+    if op not in _METHODS:
+        raise Exception('Unknown operation %s' % op)
+    method = _METHODS[op]
+    if method == 'query':
+        max_results, = struct.unpack_from('!i', body)
+        item_ids, offset = _unpack_ids(body, 4)
+        params = dict(item_ids=item_ids.tolist(), max_results=max_results)
+        offset += 1
+        if struct.unpack_from('!B', body, offset - 1)[0]:
+            candidate_ids, offset = _unpack_ids(body, offset)
+            params['candidate_ids'] = candidate_ids.astype(scipy.int64)
+        if len(body) > offset:
+            min_score, positive_only = struct.unpack_from('!dB', body, offset)
+            if not scipy.isnan(min_score):
+                params['min_score'] = min_score
+            params['positive_only'] = bool(positive_only)
+    elif method == 'query_batch':
+        max_results, n = struct.unpack_from('!iI', body)
+        item_ids_list, offset = [], 8
+        for i in xrange(n):
+            item_ids, offset = _unpack_ids(body, offset)
+            item_ids_list.append(item_ids.tolist())
+        params = dict(item_ids_list=item_ids_list, max_results=max_results)
+    else:
+        params = json.loads(body)
+    return method, params
+
+
+def _encode_response(method, result):
+    if method == 'query':
+        return _pack_results(result)
+    elif method == 'query_batch':
+        return struct.pack('!I', len(result)) + ''.join(_pack_results(r) for r in result)
+    return json.dumps(result)
+
+
+def _decode_response(method, body):
+    if method == 'query':
+        return _unpack_results(body, 0)[0]
+    elif method == 'query_batch':
+        n, = struct.unpack_from('!I', body)
+        results, offset = [], 4
+        for i in xrange(n):
+            result, offset = _unpack_results(body, offset)
+            results.append(result)
+        return results
+    return _from_json(method, json.loads(body))
+
+
+def _to_json(method, result):
+    if method == 'query':
+        return dict(vars(result), log_scores=list(result.log_scores))
+    elif method == 'query_batch':
+        return [_to_json('query', r) for r in result]
+    return result
+
+
+def _from_json(method, result):
+    if method == 'query':
+        result = dict((str(k), v) for k, v in result.items())
+        result['log_scores'] = [tuple(sc) for sc in result['log_scores']]
+        return bsets.ResultSet(**result)
+    elif method == 'query_batch':
+        return [_from_json('query', r) for r in result]
+    return [utils._O(total_score=s['total_score'], scores=[tuple(sc) for sc in s['scores']])
+        for s in result]
+
+
+class _HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        method = self.path.strip('/')
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))) or '{}')
+            result = _dispatch(self.server.query_handler, method, params)
+            self._send(200, _to_json(method, result))
+        except Exception, e:
+            logger.exception('Error in %s', method)
+            self._send(400, dict(error=str(e)))
+
+    def do_GET(self):
+        if self.path.strip('/') != 'stats':
+            return self._send(404, dict(error='Unknown path %s' % self.path))
+        query_handler = self.server.query_handler
+        cache = query_handler.cache
+        self._send(200, dict(no_items=query_handler.no_items, no_features=query_handler.no_features,
+            cache=cache.stats() if cache is not None else None))
+
+    def _send(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _BinaryRequestHandler(SocketServer.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # the frames of a connection are answered one after the other
+        while True:
+            header = self.rfile.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            op, length = _HEADER.unpack(header)
+            body = self.rfile.read(length)
+            try:
+                method, params = _decode_request(op, body)
+                result = _dispatch(self.server.query_handler, method, params)
+                body = _encode_response(method, result)
+            except Exception, e:
+                logger.exception('Error in operation %s', op)
+                op, body = ERROR, str(e)
+            self.wfile.write(_HEADER.pack(op, len(body)) + body)
+
+
+class _HTTPServer(utils.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _BinaryServer(utils.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class QueryServer(object):
+    """Serves the queries of a query handler over HTTP/JSON, the binary
+    protocol or both.
+
+    The addresses are couples (host, port), a port of 0 picks a free port
+    (see addresses). Each connection is handled in its own thread.
+    """
+    def __init__(self, query_handler, http_address=None, binary_address=None):
+        if http_address is None and binary_address is None:
+            raise Exception('An HTTP or a binary address must be given')
+        self.query_handler = query_handler
+        self.servers = []
+        if http_address is not None:
+            self.servers.append(_HTTPServer(http_address, _HTTPRequestHandler))
+        if binary_address is not None:
+            self.servers.append(_BinaryServer(binary_address, _BinaryRequestHandler))
+        for server in self.servers:
+            server.query_handler = query_handler
+        self.threads = []
+
+    @property
+    def addresses(self):
+        """The addresses the servers are bound to.
+        """
+        return [server.server_address for server in self.servers]
+
+    def start(self):
+        """Serves the requests in background threads.
+        """
+        for server in self.servers:
+            logger.info('Serving on %s:%s ...', *server.server_address)
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def serve_forever(self):
+        """Serves the requests until interrupted.
+        """
+        self.start()
+        try:
+            while any(t.is_alive() for t in self.threads):
+                for t in self.threads:
+                    t.join(1)
+        except KeyboardInterrupt:
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops serving and closes the sockets.
+        """
+        for server in self.servers:
+            if self.threads:
+                server.shutdown()
+            server.server_close()
+        self.threads = []
+
+
+class QueryClient(object):
+    """Queries a QueryServer with the binary protocol or HTTP/JSON.
+
+    The connection is kept open between the requests, so a client should
+    not be shared by several threads.
+    """
+    PROTOCOLS = ('binary', 'http')
+
+    def __init__(self, address, protocol='binary', timeout=None):
+        if protocol not in self.PROTOCOLS:
+            raise Exception('Incorrect protocol %s, choose %s' % (protocol, ', '.join(self.PROTOCOLS)))
+        self.address = address
+        self.protocol = protocol
+        self.timeout = timeout
+        self.connection = None
+
+    def query(self, item_ids, max_results=100, candidate_ids=None, min_score=None,
+        positive_only=False):
+        """Same as QueryHandler.query, the candidates are item ids.
+
+        A bitmap of the candidate rows raises a ValueError.
+        """
+        params = dict(item_ids=utils.listify(item_ids), max_results=max_results)
+        if candidate_ids is not None:
+            params['candidate_ids'] = _check_candidate_ids(candidate_ids).tolist()
+        if min_score is not None:
+            params['min_score'] = min_score
+        if positive_only:
+            params['positive_only'] = True
+        return self._request('query', params)
+
+    def query_batch(self, item_ids_list, max_results=100):
+        """Same as QueryHandler.query_batch.
+        """
+        item_ids_list = [utils.listify(item_ids) for item_ids in item_ids_list]
+        return self._request('query_batch', dict(item_ids_list=item_ids_list, max_results=max_results))
+
+    def get_detailed_scores(self, item_ids, query_item_ids, max_terms=20):
+        """Same as QueryHandler.get_detailed_scores, the query items must be given.
+        """
+        return self._request('detailed_scores', dict(item_ids=utils.listify(item_ids),
+            query_item_ids=utils.listify(query_item_ids), max_terms=max_terms))
+
+    def pipeline(self, requests):
+        """Sends all the requests, couples (method, params), before reading
+        any response and returns the results in the same order.
+
+        The methods are 'query', 'query_batch' and 'detailed_scores' and the
+        params are dicts of the arguments of the corresponding methods. This
+        saves a round trip per request with the binary protocol.
+        """
+        if self.protocol != 'binary':
+            return [self._request(method, params) for method, params in requests]
+        self._connect()
+        self.connection.sendall(''.join(_encode_request(method, params)
+            for method, params in requests))
+        return [self._read_response(method) for method, params in requests]
+
+    def _request(self, method, params):
+        self._connect()
+        if self.protocol == 'binary':
+            self.connection.sendall(_encode_request(method, params))
+            return self._read_response(method)
+        self.connection.request('POST', '/' + method, json.dumps(params),
+            {'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise Exception(result.get('error', response.reason))
+        return _from_json(method, result)
+
+    def _read_response(self, method):
+        op, length = _HEADER.unpack(self._read(_HEADER.size))
+        body = self._read(length)
+        if op == ERROR:
+            raise Exception(body)
+        return _decode_response(method, body)
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            self.close()
+            raise Exception('The connection to the server was closed')
+        return data
+
+    def _connect(self):
+        if self.connection is not None:
+            return
+        if self.protocol == 'binary':
+            self.connection = socket.create_connection(self.address, self.timeout)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.rfile = self.connection.makefile('rb')
+        else:
+            self.connection = httplib.HTTPConnection(*self.address, timeout=self.timeout)
+
+    def close(self):
+        """Closes the connection to the server.
+        """
+        if self.connection is not None:
+            if self.protocol == 'binary':
+                self.rfile.close()
+            self.connection.close()
+            self.connection = None
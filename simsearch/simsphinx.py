@@ -21,7 +21,9 @@ class SimClient(object):
     the wrapped sphinx client.
     
     The log_score of each item is found in the Sphinx attribute "log_score_attr". 
-    It must be set to 1 and declared as a float in your Sphinx configuration file.
+    It must be set to 0 and declared as a float in your Sphinx configuration file.
+    Only the best max_items items are scored, so the log scores are passed to 
+    Sphinx shifted above 1 and the hits which are not scored come last.
     """
     def __init__(self, cl=None, query_handler=None, sphinx_setup=None, **opts):
         # essential options
@@ -36,6 +38,7 @@ class SimClient(object):
         self.max_terms = opts.get('max_terms', 20)
         self.exclude_queried = opts.get('exclude_queried', True)
         self.allow_empty = opts.get('allow_empty', True)
+        self.candidate_ids = None
         if self.allow_empty:
             QuerySimilar.ALLOW_EMPTY = True
         
@@ -68,6 +71,15 @@ class SimClient(object):
         The Sphinx attribute "log_score_attr" holds each item log score.
         """
         self.sphinx_setup = setup
+
+    def SetCandidates(self, candidate_ids=None):
+        """Only score the given item ids in similarity search.
+
+        For example the ids of the items matching a Sphinx filter, so that
+        the cost of the similarity search is proportional to the filtered
+        set of items. Set to None to score all the items again.
+        """
+        self.candidate_ids = candidate_ids
     
     def Query(self, query, index='*', comment=''):
         """If the query has item ids perform a similarity search query otherwise
@@ -80,16 +92,16 @@ class SimClient(object):
         item_ids = self.query.GetItemIds()
         if item_ids:
             # perform similarity search on the set of query items
-            log_scores = self.DoSimQuery(item_ids)
+            log_scores = dict(self.DoSimQuery(item_ids, self.candidate_ids))
             # setup the sphinx client with log scores
-            self._SetupSphinxClient(item_ids, dict(log_scores))
+            self._SetupSphinxClient(item_ids, log_scores)
         
         # perform the Sphinx query
         hits = self.DoSphinxQuery(self.query, index, comment)
             
         if item_ids:
             # add the statistics to the matches
-            self._AddStats(hits, item_ids)
+            self._AddStats(hits, item_ids, log_scores)
             
         # and other statistics
         hits['time_similarity'] = self.time_similarity
@@ -97,10 +109,10 @@ class SimClient(object):
         return hits
             
     @CacheIO
-    def DoSimQuery(self, item_ids):
+    def DoSimQuery(self, item_ids, candidate_ids=None):
         """Performs the actual simlarity search query.
         """
-        results = self.query_handler.query(item_ids, self.max_items)
+        results = self.query_handler.search(item_ids, self.max_items, candidate_ids).results
         self.time_similarity = results.time
         
         return results.log_scores
@@ -118,12 +130,15 @@ class SimClient(object):
         # this fixes a nasty bug in the sphinxapi with sockets timing out 
         self.wrap_cl._timeout = None
         
-        # override log_score_attr and exclude selected ids
-        self.wrap_cl.SetOverride('log_score_attr', sphinxapi.SPH_ATTR_FLOAT, log_scores)
+        # override log_score_attr and exclude selected ids, the log scores are mostly
+        # negative so they are shifted above the default log_score_attr of 0 (or 1)
+        lowest = min(log_scores.values()) if log_scores else 0
+        self.wrap_cl.SetOverride('log_score_attr', sphinxapi.SPH_ATTR_FLOAT, 
+            dict((id, log_score - lowest + 2) for id, log_score in log_scores.items()))
         if self.exclude_queried:
             self.wrap_cl.SetFilter('@id', item_ids, exclude=True)
         
-        # only hits with non zero log scores are considered if the query is empty
+        # only hits with a shifted log score are considered if the query is empty
         if not self.query.sphinx and self.allow_empty:
            self.wrap_cl.SetFilterFloatRange('log_score_attr', 0.0, 1.0, exclude=True)
         
@@ -131,16 +146,20 @@ class SimClient(object):
         if self.sphinx_setup:
             self.sphinx_setup(self.wrap_cl)
         
-    def _AddStats(self, sphinx_results, item_ids):
+    def _AddStats(self, sphinx_results, item_ids, log_scores):
         scores = self._GetDetailedScores([match['id'] for match in sphinx_results['matches']], item_ids)
         for scores, match in zip(scores, sphinx_results['matches']):
             match['attrs']['@sim_scores'] = scores
+            # the log score itself instead of the shifted one
+            if match['id'] in log_scores:
+                match['attrs']['log_score_attr'] = log_scores[match['id']]
     
     @CacheIO
     def _GetDetailedScores(self, result_ids, query_item_ids=None):
-        scores = self.query_handler.get_detailed_scores(
+        context = self.query_handler.new_context()
+        scores = context.get_detailed_scores(
             result_ids, query_item_ids, max_terms=self.max_terms)
-        self.time_similarity = self.query_handler.time
+        self.time_similarity = context.time
         
         return scores
         
@@ -156,8 +175,8 @@ class SimClient(object):
         attrs = utils.save_attrs(self,
             [a for a in self.__dict__ if a not in ['query_handler']])
         utils.load_attrs(cl, attrs)
-        if self.query_handler:
-            cl.query_handler = bsets.QueryHandler(self.query_handler.computed_index)
+        # the query handler is shared, each query has its own context
+        cl.query_handler = self.query_handler
         return cl
 
     @classmethod
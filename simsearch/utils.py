@@ -2,7 +2,6 @@ import time
 import threading
 import logging
 import scipy
-import random
 import cPickle as pickle
 import os
 import copy
@@ -48,6 +47,9 @@ class Serializable(object):
 
 
 class ThreadingMixIn:
+    # whether the threads should not keep the process alive
+    daemon_threads = False
+
     def process_request_thread(self, request, client_address):
         try:
             self.finish_request(request, client_address)
@@ -61,6 +63,7 @@ class ThreadingMixIn:
         t = threading.Thread(
             target = self.process_request_thread,
             args   = (request, client_address))
+        t.daemon = self.daemon_threads
         t.start()
 
 
@@ -138,31 +141,311 @@ def parse_config_file(path, **opts):
 
 
 def argsort_best(arr, best_k, reverse=False):
-    """Fast computation of the best k elements in an array using a simple randomized
-    algorithm.
+    """Fast computation of the indexes of the best k elements in an array.
+
+    The k-th best element is found with numpy.argpartition and only the best
+    k elements are then sorted. The smallest elements come first unless
+    reverse is true. Ties are broken by the smallest index first, including
+    at the k-th element. If best_k is negative, the whole array is sorted.
+    """
+    arr = scipy.asarray(arr)
+    n = len(arr)
+    if best_k < 0 or best_k > n:
+        best_k = n
+    if best_k == 0:
+        return scipy.array([], dtype=scipy.int64)
+
+    keys = -arr if reverse else arr
+    if best_k < n:
+        kth = keys[scipy.argpartition(keys, best_k-1)[best_k-1]]
+        best_indexes = (keys < kth).nonzero()[0]
+        ties = (keys == kth).nonzero()[0][:best_k-len(best_indexes)]
+        best_indexes = scipy.concatenate((best_indexes, ties))
+        best_indexes.sort()
+    else:
+        best_indexes = scipy.arange(n)
+
+    return best_indexes[keys[best_indexes].argsort(kind='mergesort')]
+
+
+class TopK(object):
+    """Keeps track of the best k elements of an array given in chunks.
+
+    This is used when the array is too large to be held in memory at once.
+    Each chunk is pushed with the index of its first element and the best k
+    elements seen so far are merged with the best k elements of the chunk.
+    The same ordering and tie breaking as argsort_best apply.
+    """
+    def __init__(self, best_k, reverse=False):
+        self.best_k = best_k
+        self.reverse = reverse
+        self.indexes = scipy.array([], dtype=scipy.int64)
+        self.values = scipy.array([])
+
+    def push(self, values, offset=0, indexes=None):
+        """Adds a chunk of values starting at offset or found at the given
+        indexes (which must be increasing) of the whole array.
+        """
+        values = scipy.asarray(values)
+        if indexes is None:
+            indexes = scipy.arange(offset, offset + len(values))
+        best = argsort_best(values, self.best_k, self.reverse)
+        values = scipy.concatenate((self.values, values[best]))
+        indexes = scipy.concatenate((self.indexes, indexes[best]))
+
+        # ties are broken by index so the candidates must be in index order
+        order = indexes.argsort(kind='mergesort')
+        values, indexes = values[order], indexes[order]
+        best = argsort_best(values, self.best_k, self.reverse)
+        self.values, self.indexes = values[best], indexes[best]
+
+    def __len__(self):
+        return len(self.indexes)
+
+
+def slice_positions(indptr, rows):
+    """Returns the positions of the elements of the given rows of a compressed
+    array (for example the rows of a CSR matrix or the columns of a CSC matrix)
+    together with the number of elements of each row.
+    """
+    rows = scipy.asarray(rows, dtype=scipy.int64)
+    starts = scipy.asarray(indptr[rows], dtype=scipy.int64)
+    lengths = scipy.asarray(indptr[rows + 1], dtype=scipy.int64) - starts
+    offsets = scipy.cumsum(lengths) - lengths
+    return scipy.arange(lengths.sum()) + (starts - offsets).repeat(lengths), lengths
+
+
+class StringTable(object):
+    """A compact table of strings stored as one utf8 encoded buffer of bytes
+    together with the offsets of each string within that buffer.
+
+    It behaves like a read only list of unicode strings.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_strings(strings):
+        strings = [_utf8(s) for s in strings]
+        offsets = scipy.zeros(len(strings) + 1, dtype=scipy.int64)
+        offsets[1:] = scipy.cumsum([len(s) for s in strings])
+        data = scipy.fromstring(''.join(strings), dtype=scipy.uint8)
+        return StringTable(offsets, data)
+
+    def extend(self, strings):
+        """Appends the given strings to the table.
+
+        The arrays are replaced and not modified, so a copy of the table made
+        before is left as it was.
+        """
+        table = StringTable.from_strings(strings)
+        self.offsets = scipy.concatenate((self.offsets, self.offsets[-1] + table.offsets[1:]))
+        self.data = scipy.concatenate((self.data, table.data))
+
+    def take(self, indices):
+        """Returns a new table with the strings at the given indices.
+        """
+        positions, lengths = slice_positions(self.offsets, indices)
+        offsets = scipy.zeros(len(lengths) + 1, dtype=scipy.int64)
+        offsets[1:] = scipy.cumsum(lengths)
+        return StringTable(offsets, self.data[positions])
+
+    def tolist(self):
+        """Returns all the strings at once.
+        """
+        data = self.data.tostring()
+        offsets = self.offsets.tolist()
+        return [data[a:b].decode('utf8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring().decode('utf8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def iteritems(self):
+        return enumerate(self)
+
+
+class _IdMap(object):
+    # the dict like interface of the maps of item ids, given lookup
+
+    def get(self, id, default=None):
+        try:
+            i = int(self.lookup([id])[0])
+        except (TypeError, ValueError, OverflowError):
+            return default
+        return default if i == -1 else i
+
+    def __getitem__(self, id):
+        i = self.get(id)
+        if i is None:
+            raise KeyError(id)
+        return i
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def iteritems(self):
+        for i, id in enumerate(self.ids):
+            yield int(id), i
+
+
+class SortedIdMap(_IdMap):
+    """Maps item ids to their positions in an array of ids.
+
+    The ids are kept in sorted order and looked up with a binary search. The
+    sorted order may be given if it has already been computed.
+    """
+    def __init__(self, ids, order=None):
+        if order is None:
+            order = ids.argsort(kind='mergesort')
+        self.ids = ids
+        self.order = order
+        self.sorted_ids = ids[order]
+
+    def lookup(self, ids):
+        """Returns the positions of the given ids or -1 if an id is not found.
+        """
+        ids = scipy.asarray(ids, dtype=self.sorted_ids.dtype)
+        if not len(self):
+            return -scipy.ones(len(ids), dtype=scipy.int64)
+        pos = self.sorted_ids.searchsorted(ids).clip(0, len(self) - 1)
+        return scipy.where(self.sorted_ids[pos] == ids, self.order[pos], -1)
+
+    def extend(self, ids):
+        """Appends the given ids, which are then found after the current ids.
+
+        The arrays are replaced and not modified (see StringTable.extend).
+        """
+        ids = scipy.asarray(ids, dtype=self.ids.dtype)
+        order = ids.argsort(kind='mergesort')
+        pos = self.sorted_ids.searchsorted(ids[order], side='right')
+        self.sorted_ids = scipy.insert(self.sorted_ids, pos, ids[order])
+        self.order = scipy.insert(self.order, pos, len(self.ids) + order)
+        self.ids = scipy.concatenate((self.ids, ids))
+
+
+class DenseIdMap(_IdMap):
+    """Maps item ids to their positions in an array of ids.
+
+    The positions are kept in a table indexed by the ids minus the smallest
+    id, so an id is looked up with a single access. This is only used when
+    the ids are dense (see is_dense).
+    """
+    def __init__(self, ids):
+        self.ids = ids
+        self.start = int(ids.min()) if len(ids) else 0
+        size = int(ids.max()) - self.start + 1 if len(ids) else 0
+        self.table = -scipy.ones(size, dtype=scipy.int32 if len(ids) < 2**31 else scipy.int64)
+        self.table[ids - self.start] = scipy.arange(len(ids))
+
+    @staticmethod
+    def is_dense(ids, density=0.5):
+        """Returns whether there are at least density ids for each possible id
+        between the smallest and the largest id.
+        """
+        return len(ids) > 0 and len(ids) >= density * (int(ids.max()) - int(ids.min()) + 1)
+
+    def lookup(self, ids):
+        """Returns the positions of the given ids or -1 if an id is not found.
+        """
+        ids = scipy.asarray(ids, dtype=scipy.int64) - self.start
+        inside = (ids >= 0) & (ids < len(self.table))
+        found = -scipy.ones(len(ids), dtype=scipy.int64)
+        found[inside] = self.table[ids[inside]]
+        return found
+
+    def extend(self, ids):
+        """Appends the given ids, which are then found after the current ids.
+
+        The arrays are replaced and not modified (see StringTable.extend).
+        """
+        self.__init__(scipy.concatenate((self.ids, scipy.asarray(ids, dtype=self.ids.dtype))))
+
+    def get(self, id, default=None):
+        try:
+            i = int(id) - self.start
+        except (TypeError, ValueError, OverflowError):
+            return default
+        if i < 0 or i >= len(self.table) or self.table[i] == -1:
+            return default
+        return int(self.table[i])
+
+
+def make_id_map(ids, order=None):
+    """Returns a DenseIdMap of the ids if they are dense, otherwise a SortedIdMap.
+    """
+    if DenseIdMap.is_dense(ids):
+        return DenseIdMap(ids)
+    return SortedIdMap(ids, order)
+
+
+class SortedKeys(object):
+    """A set of integer keys stored as a few sorted arrays.
+
+    The keys are added in blocks and the blocks of about the same size are
+    merged, so the number of blocks stays logarithmic in the number of keys.
+    The keys added one at a time are kept in a set until there are enough of
+    them to make a block.
     """
-    def get_best_threshold(arr, threshold=0, sample_size=1000):
-        if len(arr) >= sample_size:
-            sample = random.sample(arr, sample_size)
-            new_threshold = scipy.mean(sample)
-        else:
-            new_threshold = arr.mean()
-
-        new_arr = arr[(arr >= new_threshold).nonzero()[0]]
-        if len(new_arr) <= best_k:
-            return threshold
-        if new_threshold == threshold:
-            return threshold
-        else:
-            return get_best_threshold(new_arr, new_threshold)
-
-    threshold = get_best_threshold(arr)
-    best_indexes = (arr >= threshold).nonzero()[0]
-
-    if (arr[best_indexes] == threshold).all():
-        best_indexes = best_indexes[:best_k]
-
-    return scipy.array(sorted(best_indexes, key=lambda i: arr[i], reverse=reverse))[:best_k]
+    def __init__(self, keys=None, pending_size=65536):
+        self.blocks = []
+        self.pending = set()
+        self.pending_size = pending_size
+        if keys is not None:
+            self.add_block(keys)
+
+    def add_block(self, keys):
+        block = scipy.unique(scipy.asarray(keys, dtype=scipy.int64))
+        if not len(block):
+            return
+        while self.blocks and len(self.blocks[-1]) <= 2 * len(block):
+            block = scipy.union1d(self.blocks.pop(), block)
+        self.blocks.append(block)
+
+    def add(self, key):
+        self.pending.add(key)
+        if len(self.pending) >= self.pending_size:
+            self._flush_pending()
+
+    def contains(self, keys):
+        """Returns a boolean array telling whether each key is in the set.
+        """
+        self._flush_pending()
+        keys = scipy.asarray(keys, dtype=scipy.int64)
+        found = scipy.zeros(len(keys), dtype=bool)
+        for block in self.blocks:
+            i = block.searchsorted(keys).clip(0, len(block) - 1)
+            found |= block[i] == keys
+        return found
+
+    def _flush_pending(self):
+        if self.pending:
+            self.add_block(list(self.pending))
+            self.pending = set()
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        for block in self.blocks:
+            i = block.searchsorted(key)
+            if i < len(block) and block[i] == key:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks) + len(self.pending)
 
 
 def get_all_sub_dirs(path):
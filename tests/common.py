@@ -0,0 +1,82 @@
+"""The fixtures shared by the test scripts.
+
+Each test script is run on its own, for example "python tests/test_update.py",
+with the sizes of its data given on the command line or the defaults. A failed
+check raises an AssertionError, so the script exits with a non zero status.
+"""
+
+import contextlib
+import numpy as np
+import sys
+import shutil
+import tempfile
+import time
+
+import simsearch
+from simsearch import utils
+
+
+def show_time_taken(func):
+    def new(*args, **kw):
+        start = time.time()
+        res = func(*args, **kw)
+        timed = time.time() - start
+        utils.logger.info('%.2f sec.', timed)
+        setattr(new, 'time_taken', timed)
+        return res
+    return new
+
+
+@contextlib.contextmanager
+def temp_index_path():
+    index_path = tempfile.mkdtemp()
+    try:
+        yield index_path
+    finally:
+        shutil.rmtree(index_path)
+
+
+def add_items(index_path, ids, r, no_features, weighted=False, mode='write'):
+    # each item gets 5 random features
+    ids = np.asarray(ids).repeat(5)
+    feats = r.randint(0, no_features, len(ids)).astype(str).astype(object)
+    values = r.randint(1, 5, len(ids)) if weighted else None
+    with simsearch.FileIndex(index_path, mode, weighted=weighted) as index:
+        index.add_many(ids, feats, values)
+
+
+def add_clustered_items(index_path, no_items, no_clusters, no_features, r):
+    # each item draws most of its features from the pool of its cluster
+    pools = r.randint(0, no_features, (no_clusters, 20))
+    clusters = r.randint(0, no_clusters, no_items)
+    ids = np.arange(no_items).repeat(13)
+    feats = np.concatenate((
+        pools[clusters.repeat(10), r.randint(0, 20, no_items * 10)].reshape(no_items, 10),
+        r.randint(0, no_features, (no_items, 3))), axis=1).ravel()
+    with simsearch.FileIndex(index_path, 'write') as index:
+        index.add_many(ids, feats.astype(str).astype(object))
+
+
+def delete_items(index_path, ids):
+    with simsearch.FileIndex(index_path, 'append') as index:
+        for id in ids:
+            index.delete(id)
+
+
+def max_diff(a, b):
+    return np.abs(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)).max() if len(a) else 0.
+
+
+def run(main, defaults, usage):
+    """Calls main with the arguments of the command line, of the same types
+    as the defaults, or with the defaults.
+    """
+    utils.logger.setLevel('WARNING')
+    args = sys.argv[1:]
+    if not args:
+        main(*defaults)
+    elif len(args) != len(defaults):
+        print 'Usage: python %s [%s]' % (sys.argv[0], usage)
+        sys.exit(2)
+    else:
+        main(*[type(default)(arg) for default, arg in zip(defaults, args)])
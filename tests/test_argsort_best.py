@@ -1,19 +1,7 @@
 import numpy as np
-import sys
-import time
 
 from simsearch import utils
-
-
-def show_time_taken(func):
-    def new(*args, **kw):
-        start = time.time()
-        res = func(*args, **kw)
-        timed = time.time() - start
-        utils.logger.info('%.2f sec.', timed)
-        setattr(new, 'time_taken', timed)
-        return res
-    return new
+from common import run, show_time_taken
 
 
 @show_time_taken
@@ -24,9 +12,23 @@ def argsort(arr):
 @show_time_taken
 def argsort_best(arr, best_k, reverse=False):
     return utils.argsort_best(arr, best_k, reverse)
+
+
+@show_time_taken
+def top_k_chunked(arr, best_k, reverse=False, chunk_size=1000000):
+    top_k = utils.TopK(best_k, reverse)
+    for offset in xrange(0, len(arr), chunk_size):
+        top_k.push(arr[offset:offset+chunk_size], offset)
+    return top_k.indexes
+
+
+def check(arr, best_indexes, k):
+    # a stable full sort gives the expected indexes (ties by smallest index)
+    expected = (-arr).argsort(kind='mergesort')[:k]
+    return (best_indexes == expected).all()
     
 
-def test(arr, k):
+def check_array(arr, k):
     best_indexes = argsort_best(arr, k, reverse=True)
 
     print 'Array = %s' % arr
@@ -35,6 +37,11 @@ def test(arr, k):
     print 'Number of indexes = %s' % len(best_indexes)
     print 'Best element = %s' % np.max(arr)
     print 'Took %.2f sec.' % argsort_best.time_taken
+    assert check(arr, best_indexes, k), 'Not the same as a stable full sort'
+
+    best_indexes = top_k_chunked(arr, k, reverse=True)
+    print 'In chunks took %.2f sec.' % top_k_chunked.time_taken
+    assert check(arr, best_indexes, k), 'Not the same as a stable full sort in chunks'
 
     argsort(arr)
     print 'To be compared with full sorting takes %.2f sec.' % argsort.time_taken
@@ -42,16 +49,13 @@ def test(arr, k):
 
 def main(arr_size, k):
     arr = np.array(xrange(arr_size))
-    test(arr, k)
+    check_array(arr, k)
 
     arr = np.random.sample(arr_size)
-    test(arr, k)
+    check_array(arr, k)
 
     arr = np.ones(arr_size)
-    test(arr, k)
+    check_array(arr, k)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print 'Usage: python %s size_array number_of_k_elements' % sys.argv[0]
-    else:
-        main(*map(int, sys.argv[1:]))
+    run(main, (10000000, 1000), 'size_array number_of_k_elements')
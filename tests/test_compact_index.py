@@ -0,0 +1,31 @@
+import numpy as np
+
+import simsearch
+from common import add_items, delete_items, run, temp_index_path
+
+
+def main(no_items, deleted_ratio):
+    r = np.random.RandomState(0)
+    with temp_index_path() as index_path:
+        add_items(index_path, np.arange(no_items), r, no_items / 10)
+        simsearch.convert_index(index_path)
+        deleted = r.permutation(no_items)[:int(no_items * deleted_ratio)]
+        delete_items(index_path, deleted)
+        compacted = simsearch.compact_index(index_path, max_deleted_ratio=deleted_ratio / 2)
+
+        # the binary index is converted again from the compacted text index
+        binary = simsearch.BinaryIndex.exists(index_path)
+        stale = binary and bool(simsearch.indexer.text_index_changes(
+            simsearch.BinaryIndex.read_header(index_path)))
+        live = sorted(set(range(no_items)) - set(deleted.tolist()))
+        same_items = binary and sorted(simsearch.BinaryIndex(index_path).ids.tolist()) == live
+        print 'compacted | binary index | stale | same items'
+        print '%9s | %12s | %5s | %s' % (compacted, binary, stale, same_items)
+
+        assert compacted, 'The index was not compacted'
+        assert binary, 'The binary index was not converted again'
+        assert not stale, 'The binary index is older than the text index'
+        assert same_items, 'The binary index does not hold the items left'
+
+if __name__ == '__main__':
+    run(main, (10000, 0.3), 'number_of_items ratio_of_deleted_items')
@@ -0,0 +1,56 @@
+import numpy as np
+import time
+
+import simsearch
+from common import add_clustered_items, run, show_time_taken, temp_index_path
+
+
+@show_time_taken
+def run_queries(handler, queries, k):
+    return [list(handler.query(q, k).log_scores) for q in queries]
+
+
+def recall(exact, approximate):
+    found = [len(set(id for id, sc in a) & set(id for id, sc in e)) / float(max(len(e), 1))
+        for e, a in zip(exact, approximate)]
+    return np.mean(found)
+
+
+def scored_exactly(exact, approximate):
+    # the candidates found are scored as in the exact search
+    for e, a in zip(exact, approximate):
+        e = dict(e)
+        if not all(np.allclose(sc, e[id]) for id, sc in a if id in e):
+            return False
+    return True
+
+
+def main(no_items, no_queries, k):
+    with temp_index_path() as index_path:
+        add_clustered_items(index_path, no_items, no_items / 100, no_items, np.random.RandomState(0))
+        index = simsearch.ComputedIndex(index_path)
+
+    r = np.random.RandomState(1)
+    queries = [r.randint(0, no_items, r.randint(1, 4)).tolist() for i in range(no_queries)]
+    exact = run_queries(simsearch.QueryHandler(index), queries, k)
+    exact_time = run_queries.time_taken / no_queries
+    print 'Exact: %.2f ms per query' % (1000 * exact_time)
+
+    print 'bands x rows | build (sec.) | ms per query | speed up | recall@%s' % k
+    for no_bands, rows_per_band in [(16, 1), (32, 1), (16, 2), (32, 2), (64, 2)]:
+        start = time.time()
+        lsh = simsearch.MinHashLSH(index, no_bands, rows_per_band)
+        build_time = time.time() - start
+        approximate = run_queries(simsearch.QueryHandler(index, lsh=lsh), queries, k)
+        query_time = run_queries.time_taken / no_queries
+        found = recall(exact, approximate)
+        print '%5s x %-4s  | %12.2f | %12.2f | %8.1f | %.3f' % (no_bands, rows_per_band,
+            build_time, 1000 * query_time, exact_time / query_time, found)
+
+        assert scored_exactly(exact, approximate), \
+            'The candidates of %s x %s are not scored exactly' % (no_bands, rows_per_band)
+        # the items of a cluster share most of their features, so most are found
+        assert found >= 0.5, 'The recall of %s x %s is only %.3f' % (no_bands, rows_per_band, found)
+
+if __name__ == '__main__':
+    run(main, (200000, 100, 10), 'number_of_items number_of_queries number_of_k_elements')
@@ -0,0 +1,44 @@
+import numpy as np
+
+import simsearch
+from common import add_items, delete_items, run, temp_index_path
+
+
+def same_results(handler, item_ids, single, batch):
+    # the scores are summed in another order, so only the near ties may be ordered differently,
+    # the exact ties must be broken by smallest index as well
+    if len(single.log_scores) != len(batch.log_scores):
+        return False
+    scores = dict(handler.query(item_ids, -1).log_scores)
+    for (id_s, sc_s), (id_b, sc_b) in zip(single.log_scores, batch.log_scores):
+        if not np.isclose(sc_s, sc_b, rtol=1e-12, atol=1e-9):
+            return False
+        if id_s != id_b and (scores[id_s] == scores[id_b] or not np.isclose(scores[id_b], sc_s)):
+            return False
+    return True
+
+
+def main(no_items, no_queries, block_size):
+    r = np.random.RandomState(0)
+    with temp_index_path() as index_path:
+        # few features so that many items have the same features and are tied
+        add_items(index_path, np.arange(no_items), r, 10)
+        deleted = r.randint(0, no_items, no_items / 10)
+        delete_items(index_path, deleted)
+        handler = simsearch.QueryHandler(simsearch.ComputedIndex(index_path))
+
+    # queries of 1 to 4 items, with deleted items and items not in the index
+    queries = [r.randint(0, no_items, r.randint(1, 5)).tolist() for i in range(no_queries)]
+    queries += [deleted[:2].tolist(), [no_items + 1], [int(deleted[0]), 0]]
+    print 'max results | queries | same as query'
+    for max_results in (10, 100, -1):
+        batch = handler.query_batch(queries, max_results, block_size)
+        same = [same_results(handler, q, handler.query(q, max_results), b)
+            for q, b in zip(queries, batch)]
+        print '%11s | %7s | %s' % (max_results, len(queries), all(same))
+
+        assert all(same), 'query_batch differs from query for %s' % [
+            q for q, s in zip(queries, same) if not s]
+
+if __name__ == '__main__':
+    run(main, (2000, 50, 7), 'number_of_items number_of_queries block_size')
@@ -0,0 +1,69 @@
+import numpy as np
+
+import simsearch
+from common import add_items, run, temp_index_path
+
+
+class FakeSphinxClient(object):
+    """Matches all the documents and sorts them by log_score_attr, like searchd
+    with SPH_SORT_EXPR, the documents keeping the default log_score_attr of 0.
+    """
+    query_parser = None
+    cache = None
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.overrides = {}
+        self.filters = []
+
+    def SetOverride(self, attribute, type, values):
+        self.overrides = values
+
+    def SetFilter(self, attribute, values, exclude=0):
+        self.filters.append(lambda id, score: (id in values) != bool(exclude))
+
+    def SetFilterFloatRange(self, attribute, min_, max_, exclude=0):
+        self.filters.append(lambda id, score: (min_ <= score <= max_) != bool(exclude))
+
+    def Query(self, query):
+        # the attribute is stored in single precision
+        scores = [(id, float(np.float32(self.overrides.get(id, 0.)))) for id in self.ids]
+        scores = [(id, sc) for id, sc in scores if all(f(id, sc) for f in self.filters)]
+        scores.sort(key=lambda x: -x[1])
+        return dict(matches=[dict(id=id, attrs=dict(log_score_attr=sc)) for id, sc in scores])
+
+
+def check(cl, handler, query, item_id, max_items):
+    hits = cl.Query(query)
+    results = handler.query(item_id, max_items)
+    expected = [id for id, sc in results.log_scores if id != item_id]
+    scores = dict(results.log_scores)
+
+    ids = [match['id'] for match in hits['matches']]
+    attrs = [match['attrs']['log_score_attr'] for match in hits['matches']]
+    scored = ids[:len(expected)]
+    # the scored hits first, best first, holding their log scores
+    same_order = scored == expected and all(a == scores[id] for id, a in zip(scored, attrs))
+    return same_order, len(ids) - len(scored), sum(sc < 0 for sc in scores.values())
+
+
+def main(no_items, max_items):
+    with temp_index_path() as index_path:
+        add_items(index_path, np.arange(no_items), np.random.RandomState(0), no_items / 10)
+        handler = simsearch.QueryHandler(simsearch.ComputedIndex(index_path))
+        print 'query                | same order | unscored hits | negative log scores'
+        for query, empty in (('@similar 3', True), ('some text @similar 3', False)):
+            cl = simsearch.SimClient(FakeSphinxClient(range(no_items)), handler, 
+                max_items=max_items)
+            same, unscored, negative = check(cl, handler, query, 3, max_items)
+            print '%-20s | %10s | %13s | %s' % (query, same, unscored, negative)
+
+            assert same, 'The scored hits of %r are not first, best first' % query
+            assert negative, 'No negative log score for %r, the ordering is not checked' % query
+            # the unscored hits are only left out of an empty query
+            expected = 0 if empty else no_items - max_items
+            assert unscored == expected, '%s unscored hits for %r instead of %s' % (
+                unscored, query, expected)
+
+if __name__ == '__main__':
+    run(main, (1000, 50), 'number_of_items max_items')
@@ -0,0 +1,82 @@
+import numpy as np
+import copy
+
+import simsearch
+from common import add_items, delete_items, max_diff, run, temp_index_path
+
+
+def check_hyper_parameters(index):
+    # the updated hyper parameters against those computed from the updated matrix
+    ref = copy.copy(index)
+    ref._compute_hyper_parameters()
+    return max(max_diff(getattr(index, name), getattr(ref, name))
+        for name in simsearch.ComputedIndex.HYPER_PARAMETERS)
+
+
+def check_rebuild(index, fresh):
+    # the updated matrix against the matrix of the whole index, with the columns mapped by feature
+    columns = dict((f, i) for i, f in enumerate(fresh.index_to_feat))
+    columns = np.array([columns[f] for f in index.index_to_feat])
+    rows = fresh.item_id_to_index.lookup(index.index_to_item_id)
+    same_X = (fresh.X[rows][:,columns] != index.X).nnz == 0
+    no_deleted = lambda i: np.zeros(i.no_items, dtype=bool) if i.deleted is None else i.deleted
+    same_deleted = (no_deleted(fresh)[rows] == no_deleted(index)).all()
+    return same_X and same_deleted, max_diff(index.mean, fresh.mean[columns])
+
+
+def check_compacted(index_path, index):
+    # the deleted items are removed for good, so the computed index can't be updated
+    simsearch.compact_index(index_path, max_deleted_ratio=0)
+    try:
+        index.update()
+    except Exception:
+        return True
+    return False
+
+
+def main(no_items, no_updates):
+    cases = [
+        ('binary', dict()),
+        ('binary float32', dict(dtype='float32')),
+        ('pruned', dict(min_df=3, max_df=0.5)),
+        ('tf-idf', dict(weighting='tf-idf')),
+    ]
+    print 'case           | hyper parameters | same matrix | mean vs rebuild | refused after compaction'
+    for name, options in cases:
+        weighted = 'weighting' in options
+        r = np.random.RandomState(0)
+        with temp_index_path() as index_path:
+            # the last features are only found in the new items
+            no_features = no_items / 10
+            add_items(index_path, np.arange(no_items), r, no_features, weighted)
+            index = simsearch.ComputedIndex(index_path, **options)
+            start = no_items
+            for i in range(no_updates):
+                # new items with new features, new features of existing items and deletions
+                new_ids = np.arange(start, start + no_items / 10)
+                start += len(new_ids)
+                no_features += 10
+                add_items(index_path, new_ids, r, no_features, weighted, mode='append')
+                if not weighted:
+                    add_items(index_path, r.randint(0, start, no_items / 20), r, no_features,
+                        weighted, mode='append')
+                delete_items(index_path, r.randint(0, start, no_items / 50))
+                index.update()
+
+            fresh = simsearch.ComputedIndex(index_path, weighting=options.get('weighting', 'binary'))
+            hyper_diff = check_hyper_parameters(index)
+            if weighted:
+                # the inverse document frequencies are those of the creation of the index
+                same, mean_diff = True, 0.
+            else:
+                same, mean_diff = check_rebuild(index, fresh)
+            refused = check_compacted(index_path, index)
+            print '%-14s | %16.1e | %11s | %15.1e | %s' % (name, hyper_diff, same, mean_diff, refused)
+
+            assert hyper_diff < 1e-4, 'The hyper parameters of %s differ by %s' % (name, hyper_diff)
+            assert same, 'The updated matrix of %s differs from the rebuilt one' % name
+            assert mean_diff < 1e-8, 'The mean of %s differs by %s' % (name, mean_diff)
+            assert refused, 'The update of %s was not refused after compaction' % name
+
+if __name__ == '__main__':
+    run(main, (20000, 5), 'number_of_items number_of_updates')
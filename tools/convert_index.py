@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+import sys
+import getopt
+import simsearch
+
+
+def convert(index_path, out_path=None, snapshot=False, dtype='float64'):
+    if snapshot:
+        index = simsearch.ComputedIndex(index_path, dtype=dtype)
+        index.dump_snapshot(out_path or index_path)
+    else:
+        simsearch.convert_index(index_path, out_path)
+
+
+def usage():
+    print 'Usage: python convert_index.py [options] index_path'
+    print
+    print 'Description:'
+    print '    Converts a similarity search index into the binary format.'
+    print '    The binary index is memory mapped when loaded and is written'
+    print '    alongside the text index unless otherwise specified.'
+    print '    A snapshot also holds the computed hyper parameters.'
+    print
+    print 'Options:'
+    print '    -o, --out         : path to the binary index (default index_path)'
+    print '    -s, --snapshot    : save a snapshot of the computed index'
+    print '    -f, --float32     : store the snapshot in single precision'
+    print '    -h, --help        : this help message'
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:sfh', ['out=', 'snapshot', 'float32', 'help'])
+    except getopt.GetoptError:
+        usage(); sys.exit(2)
+
+    out_path, snapshot, dtype = None, False, 'float64'
+    for o, a in opts:
+        if o in ('-o', '--out'):
+            out_path = a
+        elif o in ('-s', '--snapshot'):
+            snapshot = True
+        elif o in ('-f', '--float32'):
+            dtype = 'float32'
+        elif o in ('-h', '--help'):
+            usage(); sys.exit()
+
+    if len(args) < 1:
+        usage()
+    else:
+        convert(args[0], out_path, snapshot, dtype)
+
+if __name__ == '__main__':
+    main()
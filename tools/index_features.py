@@ -10,7 +10,7 @@ def make_index(config_path, **opts):
     opts = utils.parse_config_file(config_path, **opts)
     index = simsearch.FileIndex(opts.index_path, mode=opts.mode)
     iter_feat = simsearch.BagOfWordsIter(opts.db_params, opts.sql_features, opts.get('limit', 0))
-    simsearch.Indexer(index, iter_feat).index_data()
+    simsearch.Indexer(index, iter_feat, opts.get('processes')).index_data()
 
 
 def usage():
@@ -25,14 +25,15 @@ def usage():
     print '    -o, --out         : path to the index (default ./sim-index/)'
     print '    -m, --mode        : "write" or "append" to the index (defaut write)'
     print '    -l, --limit       : loop only over the first "limit" number of items'
+    print '    -p, --processes   : index each SQL statement in parallel with "processes"'
     print '    -h, --help        : this help message'
 
 
 def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:], 
-            'o:m:v:l:h', 
-            ['out=', 'mode=', 'verbose=', 'limit=', 'help'])
+            'o:m:v:l:p:h', 
+            ['out=', 'mode=', 'verbose=', 'limit=', 'processes=', 'help'])
     except getopt.GetoptError:
         usage(); sys.exit(2)
 
@@ -45,6 +46,8 @@ def main():
                 _opts['mode'] = a
         elif o in ('-l', '--limit'):
             _opts['limit'] = int(a)
+        elif o in ('-p', '--processes'):
+            _opts['processes'] = int(a)
         elif o in ('-h', '--help'):
             usage(); sys.exit()
 
@@ -4,8 +4,8 @@ import getopt
 import simsearch
 
 
-def query(index_path, matching_keywords=False):
-    index = simsearch.ComputedIndex(index_path)
+def query(index_path, matching_keywords=False, weighting='binary'):
+    index = simsearch.ComputedIndex(index_path, weighting)
     query_handler = simsearch.QueryHandler(index)
 
     while(True):
@@ -13,20 +13,21 @@ def query(index_path, matching_keywords=False):
         print '>> Enter some item ids: (try %s)' % sample_ids
 
         item_ids = map(int, raw_input().split())
-        result_set = query_handler.query(item_ids, max_results=10000)
+        context = query_handler.search(item_ids, max_results=10000)
+        result_set = context.results
 
         print result_set
 
         if matching_keywords:
             ids = [id for id, sc in result_set.log_scores][0:10]
-            show_matching_keywords(ids, query_handler)
+            show_matching_keywords(ids, context)
 
 
-def show_matching_keywords(ids, query_handler):
-    item_scores = query_handler.get_detailed_scores(ids)
+def show_matching_keywords(ids, context):
+    item_scores = context.get_detailed_scores(ids)
 
     print 'Top matching keywords (%.2f sec.):' % \
-        query_handler.get_detailed_scores.time_taken
+        context._time_taken__compute_detailed_scores
 
     for scores, id in zip(item_scores, ids):
         print '*' * 80
@@ -43,26 +44,29 @@ def usage():
     print
     print 'Options:'
     print '    -v, --verbose     : also show matching keywords'
+    print '    -w, --weighting   : "binary", "tf" or "tf-idf" (default binary)'
     print '    -h, --help        : this help message'
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'vh', ['verbose', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'vw:h', ['verbose', 'weighting=', 'help'])
     except getopt.GetoptError:
         usage(); sys.exit(2)
 
-    verbose = False
+    verbose, weighting = False, 'binary'
     for o, a in opts:
         if o in ('-v', '--verbose'):
             verbose = True
+        elif o in ('-w', '--weighting'):
+            weighting = a
         elif o in ('-h', '--help'):
             usage(); sys.exit()
 
     if len(args) < 1:
         usage()
     else:
-        query(args[0], verbose)
+        query(args[0], verbose, weighting)
 
 if __name__ == '__main__':
     main()
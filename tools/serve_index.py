@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+import sys
+import getopt
+import simsearch
+
+
+def serve(index_path, host='localhost', http_port=8090, binary_port=8091, weighting='binary',
+    inverted=False, cache_size=0, dtype='float64', chunk_size=None):
+    index = simsearch.load_index(index_path) if weighting == 'binary' and dtype == 'float64' \
+        else simsearch.ComputedIndex(index_path, weighting, dtype=dtype)
+    cache = simsearch.QueryCache(max_entries=cache_size) if cache_size else None
+    query_handler = simsearch.QueryHandler(index, inverted=inverted, cache=cache,
+        chunk_size=chunk_size)
+
+    server = simsearch.QueryServer(query_handler,
+        (host, http_port) if http_port else None,
+        (host, binary_port) if binary_port else None)
+    server.serve_forever()
+
+
+def usage():
+    print 'Usage: python serve_index.py [options] index_path'
+    print
+    print 'Description:'
+    print '    Loads a similarity search index once and serves its queries'
+    print '    over HTTP/JSON and over a binary protocol (see simsearch.QueryClient).'
+    print
+    print 'Options:'
+    print '    -H, --host        : host to bind to (default localhost)'
+    print '    -p, --port        : HTTP port, 0 to disable (default 8090)'
+    print '    -b, --binary-port : binary protocol port, 0 to disable (default 8091)'
+    print '    -w, --weighting   : "binary", "tf" or "tf-idf" (default binary)'
+    print '    -i, --inverted    : only visit the items sharing a feature with the query'
+    print '    -c, --cache       : cache the results of "cache" queries (default none)'
+    print '    -f, --float32     : compute the index in single precision'
+    print '    -k, --chunk-size  : score "chunk-size" items at a time (default all)'
+    print '    -h, --help        : this help message'
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'H:p:b:w:ic:fk:h',
+            ['host=', 'port=', 'binary-port=', 'weighting=', 'inverted', 'cache=', 'float32', 'chunk-size=',
+            'help'])
+    except getopt.GetoptError:
+        usage(); sys.exit(2)
+
+    _opts = {}
+    for o, a in opts:
+        if o in ('-H', '--host'):
+            _opts['host'] = a
+        elif o in ('-p', '--port'):
+            _opts['http_port'] = int(a)
+        elif o in ('-b', '--binary-port'):
+            _opts['binary_port'] = int(a)
+        elif o in ('-w', '--weighting'):
+            _opts['weighting'] = a
+        elif o in ('-i', '--inverted'):
+            _opts['inverted'] = True
+        elif o in ('-c', '--cache'):
+            _opts['cache_size'] = int(a)
+        elif o in ('-f', '--float32'):
+            _opts['dtype'] = 'float32'
+        elif o in ('-k', '--chunk-size'):
+            _opts['chunk_size'] = int(a)
+        elif o in ('-h', '--help'):
+            usage(); sys.exit()
+
+    if len(args) < 1:
+        usage()
+    else:
+        serve(args[0], **_opts)
+
+if __name__ == '__main__':
+    main()